@@ -10,6 +10,7 @@ use anyhow::Result;
 use regex::Regex;
 use std::collections::BTreeSet;
 use std::fs;
+use std::io::{BufWriter, Write};
 use std::path::Path;
 use types::{AtRule, AtRuleDescriptor, Data, Property, Value};
 
@@ -77,6 +78,11 @@ fn add_bare_fit_content(syntax: &str) -> String {
     }
 }
 
+/// Waits for a download thread, turning a panic into an error.
+fn join<T>(handle: std::thread::ScopedJoinHandle<'_, Result<T>>) -> Result<T> {
+    handle.join().map_err(|_| anyhow::anyhow!("download thread panicked"))?
+}
+
 fn main() -> Result<()> {
     // A value-definition-syntax comma multiplier at the very end of a grammar.
     let trailing_comma_multiplier = Regex::new(r"#(\{[0-9]+(,[0-9]*)?\})?\s*$")?;
@@ -95,8 +101,14 @@ fn main() -> Result<()> {
         .user_agent("gosub-generate-definitions")
         .build()?;
 
-    let webref_data = webref::get_webref_data(&client)?;
-    let mdn_data = mdn::get_mdn_data(&client)?;
+    // The downloads are independent of each other, so run them concurrently.
+    // They share the client, and so its pool of kept-alive connections.
+    let (webref_data, mdn_data, mdn_syntaxes) = std::thread::scope(|s| {
+        let webref_data = s.spawn(|| webref::get_webref_data(&client));
+        let mdn_data = s.spawn(|| mdn::get_mdn_data(&client));
+        let mdn_syntaxes = s.spawn(|| mdn::get_mdn_syntaxes(&client));
+        Ok::<_, anyhow::Error>((join(webref_data)?, join(mdn_data)?, join(mdn_syntaxes)?))
+    })?;
 
     let mut data = Data::default();
 
@@ -166,7 +178,7 @@ fn main() -> Result<()> {
     // not fully cover (e.g. outline-radius, single-animation-*). Add every
     // entry webref did not already define, so grammar references to them
     // resolve.
-    for (name, syntax) in mdn::get_mdn_syntaxes(&client)? {
+    for (name, syntax) in mdn_syntaxes {
         let key = format!("<{name}>");
         if syntax.is_empty() || defined_values.contains(&key) {
             continue;
@@ -330,8 +342,20 @@ fn export_multi_file(data: &Data) -> Result<()> {
 }
 
 fn export_data<T: serde::Serialize>(data: &T, path: &Path) -> Result<()> {
-    let mut out = serde_json::to_vec_pretty(data)?;
-    out.push(b'\n');
-    fs::write(path, out)?;
+    // Serialize straight into a temporary file instead of into an in-memory buffer,
+    // and only replace the output once it is complete.
+    let tmp_path = path.with_extension("json.tmp");
+    let result = write_json(data, &tmp_path).and_then(|()| Ok(fs::rename(&tmp_path, path)?));
+    if result.is_err() {
+        let _ = fs::remove_file(&tmp_path);
+    }
+    result
+}
+
+fn write_json<T: serde::Serialize>(data: &T, path: &Path) -> Result<()> {
+    let mut out = BufWriter::new(fs::File::create(path)?);
+    serde_json::to_writer_pretty(&mut out, data)?;
+    out.write_all(b"\n")?;
+    out.flush()?;
     Ok(())
 }
@@ -6,6 +6,7 @@ use crate::types::StringMaybeArray;
 use anyhow::{Context, Result};
 use serde::Deserialize;
 use std::collections::BTreeMap;
+use std::io::BufReader;
 
 const MDN_PROPERTIES: &str = "https://raw.githubusercontent.com/mdn/data/main/css/properties.json";
 const MDN_SYNTAXES: &str = "https://raw.githubusercontent.com/mdn/data/main/css/syntaxes.json";
@@ -30,8 +31,9 @@ struct MdnSyntax {
 
 pub fn get_mdn_data(client: &reqwest::blocking::Client) -> Result<BTreeMap<String, MdnItem>> {
     let resp = client.get(MDN_PROPERTIES).send()?.error_for_status()?;
-    let body = resp.bytes()?;
-    serde_json::from_slice(&body).context("parsing MDN properties.json")
+    // Deserialize straight from the response stream instead of buffering the
+    // whole body first.
+    serde_json::from_reader(BufReader::new(resp)).context("parsing MDN properties.json")
 }
 
 /// Returns MDN's value-type dictionary (css/syntaxes.json) as a map of type
@@ -39,8 +41,8 @@ pub fn get_mdn_data(client: &reqwest::blocking::Client) -> Result<BTreeMap<Strin
 /// these value types, so they are used to backfill value definitions.
 pub fn get_mdn_syntaxes(client: &reqwest::blocking::Client) -> Result<BTreeMap<String, String>> {
     let resp = client.get(MDN_SYNTAXES).send()?.error_for_status()?;
-    let body = resp.bytes()?;
-    let raw: BTreeMap<String, MdnSyntax> = serde_json::from_slice(&body).context("parsing MDN syntaxes.json")?;
+    let raw: BTreeMap<String, MdnSyntax> =
+        serde_json::from_reader(BufReader::new(resp)).context("parsing MDN syntaxes.json")?;
 
     Ok(raw.into_iter().map(|(name, item)| (name, item.syntax)).collect())
 }
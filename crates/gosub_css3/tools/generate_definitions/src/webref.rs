@@ -8,6 +8,7 @@ use serde::Deserialize;
 use sha1::{Digest, Sha1};
 use std::collections::BTreeMap;
 use std::fs;
+use std::io::BufReader;
 use std::path::Path;
 
 const REPO: &str = "w3c/webref";
@@ -137,8 +138,7 @@ pub fn get_webref_data(client: &reqwest::blocking::Client) -> Result<WebRefData>
 fn get_webref_files(client: &reqwest::blocking::Client) -> Result<Vec<DirectoryListItem>> {
     let url = format!("https://api.github.com/repos/{REPO}/contents/{LOCATION}?ref={BRANCH}");
     let resp = client.get(&url).send()?.error_for_status()?;
-    let body = resp.bytes()?;
-    serde_json::from_slice(&body).context("parsing webref directory listing")
+    serde_json::from_reader(BufReader::new(resp)).context("parsing webref directory listing")
 }
 
 /// Returns the file's content, from the local cache when it still matches the
@@ -0,0 +1,434 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+"""The parsing machine of `funcparserlib.parser` compiled to C with Cython.
+
+It runs the same opcodes as `parser._vm_run()`, with the registers and the
+opcodes typed as C integers. `Parser.parse_fast()` uses it if it has been built,
+e.g. by running the following in the directory containing `lint_lib`:
+
+    cythonize -i lint_lib/_vendor/funcparserlib/_vm.pyx
+
+Keep it in sync with `parser._vm_run()`: the module refuses to import if the
+opcodes below are numbered differently from the ones of `parser`.
+"""
+
+import sys
+
+from lint_lib._vendor.funcparserlib import parser as _parser
+from lint_lib._vendor.funcparserlib.lexer import Token
+from lint_lib._vendor.funcparserlib.parser import (
+    NoParseError,
+    State,
+    _Ignored,
+    _seq_value,
+)
+
+cdef enum:
+    MATCH_PRED
+    MATCH_EQ
+    MATCH_TYPE
+    MATCH_TOKEN
+    FINISHED
+    PURE
+    CALL
+    CALL_MEMO
+    RETURN
+    CALL_SECTION
+    RETURN_SECTION
+    SHIFT
+    IGNORE
+    PUSH_TUPLE
+    ALT
+    ALT_FIRST
+    ALT_TYPE
+    DISPATCH
+    DISPATCH_TYPE
+    COMMIT
+    PUSH_LIST
+    APPEND
+    MANY
+    MATCH_MANY
+    END
+
+_OPCODES = [
+    ("_MATCH_PRED", MATCH_PRED),
+    ("_MATCH_EQ", MATCH_EQ),
+    ("_MATCH_TYPE", MATCH_TYPE),
+    ("_MATCH_TOKEN", MATCH_TOKEN),
+    ("_FINISHED", FINISHED),
+    ("_PURE", PURE),
+    ("_CALL", CALL),
+    ("_CALL_MEMO", CALL_MEMO),
+    ("_RETURN", RETURN),
+    ("_CALL_SECTION", CALL_SECTION),
+    ("_RETURN_SECTION", RETURN_SECTION),
+    ("_SHIFT", SHIFT),
+    ("_IGNORE", IGNORE),
+    ("_PUSH_TUPLE", PUSH_TUPLE),
+    ("_ALT", ALT),
+    ("_ALT_FIRST", ALT_FIRST),
+    ("_ALT_TYPE", ALT_TYPE),
+    ("_DISPATCH", DISPATCH),
+    ("_DISPATCH_TYPE", DISPATCH_TYPE),
+    ("_COMMIT", COMMIT),
+    ("_PUSH_LIST", PUSH_LIST),
+    ("_APPEND", APPEND),
+    ("_MANY", MANY),
+    ("_MATCH_MANY", MATCH_MANY),
+    ("_END", END),
+]
+for _name, _opcode in _OPCODES:
+    if getattr(_parser, _name, None) != _opcode:
+        raise ImportError("%s is stale, rebuild it from _vm.pyx" % __name__)
+
+
+def vm_run(const int[:] code, list consts, tokens, s, memo=None):
+    """Run the opcodes compiled by `Parser._compile()` like `parser._vm_run()`."""
+    cdef Py_ssize_t n = len(tokens)
+    cdef Py_ssize_t pos = s.pos
+    cdef Py_ssize_t max_pos = s.max
+    cdef Py_ssize_t expected_at = -1
+    cdef Py_ssize_t pc = 0
+    cdef Py_ssize_t max_depth = sys.getrecursionlimit()
+    cdef Py_ssize_t k, start, depth, caller_max
+    cdef int op
+    cdef list values = []
+    cdef list frames = []
+    cdef list parts
+    expected = s.parser
+    msg = None
+    while True:
+        op = code[pc]
+        arg = consts[pc]
+        pc += 1
+        if op == MATCH_PRED:
+            (p, pred, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if pred(t):
+                    values.append(t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == MATCH_EQ:
+            (p, value, as_value, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                # Not PyObject_RichCompareBool(), which takes identical objects for
+                # equal ones without calling __eq__()
+                if t == value:
+                    values.append(t.value if as_value else t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == MATCH_TYPE:
+            (p, type, as_value, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if t.type == type:
+                    values.append(t.value if as_value else t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == MATCH_TOKEN:
+            (p, type, value, token, as_value, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if (
+                    t.type == type and t.value == value
+                    if t.__class__ is Token
+                    else t == token
+                ):
+                    values.append(t.value if as_value else t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == PUSH_TUPLE:
+            (k, kept) = arg
+            parts = values[len(values) - k :]
+            del values[len(values) - k :]
+            values.append(_seq_value(parts, kept))
+            continue
+        elif op == ALT:
+            frames.append((arg[0], pos, len(values), arg[1]))
+            continue
+        elif op == ALT_FIRST:
+            (next_alt, failed, keys, by_token, skipped) = arg
+            if pos < n:
+                t = tokens[pos]
+                try:
+                    found = ((t.type, t.value) if by_token else t) in keys
+                except (AttributeError, TypeError):
+                    found = True
+                if found:
+                    frames.append((next_alt, pos, len(values), failed))
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if next_alt is not None:
+                pc = next_alt
+                continue
+        elif op == ALT_TYPE:
+            (next_alt, failed, keys, skipped) = arg
+            if pos < n:
+                try:
+                    found = tokens[pos].type in keys
+                except (AttributeError, TypeError):
+                    found = True
+                if found:
+                    frames.append((next_alt, pos, len(values), failed))
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if next_alt is not None:
+                pc = next_alt
+                continue
+        elif op == DISPATCH:
+            (by_token, table, other) = arg
+            if pos < n:
+                t = tokens[pos]
+                try:
+                    (target, skipped) = table.get(
+                        (t.type, t.value) if by_token else t, other
+                    )
+                except (AttributeError, TypeError):
+                    continue
+                msg = "got unexpected token"
+            else:
+                (target, skipped) = other
+                msg = "got unexpected end of input"
+            if skipped is not None and pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if target is not None:
+                pc = target
+                continue
+        elif op == DISPATCH_TYPE:
+            (table, other) = arg
+            if pos < n:
+                try:
+                    (target, skipped) = table.get(tokens[pos].type, other)
+                except (AttributeError, TypeError):
+                    continue
+                msg = "got unexpected token"
+            else:
+                (target, skipped) = other
+                msg = "got unexpected end of input"
+            if skipped is not None and pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if target is not None:
+                pc = target
+                continue
+        elif op == COMMIT:
+            frames.pop()
+            pc = arg
+            continue
+        elif op == SHIFT:
+            values[len(values) - 1] = arg(values[len(values) - 1])
+            continue
+        elif op == MANY:
+            frames.pop()
+            v = values.pop()
+            values[len(values) - 1].append(v)
+            pc = arg
+            continue
+        elif op == MATCH_MANY:
+            (match_op, match_arg) = arg
+            start = pos
+            if match_op == MATCH_TYPE:
+                (p, type, as_value, _) = match_arg
+                while pos < n and tokens[pos].type == type:
+                    pos += 1
+            elif match_op == MATCH_EQ:
+                (p, value, as_value, _) = match_arg
+                while pos < n and tokens[pos] == value:
+                    pos += 1
+            elif match_op == MATCH_TOKEN:
+                (p, type, value, token, as_value, _) = match_arg
+                while pos < n:
+                    t = tokens[pos]
+                    if not (
+                        t.type == type and t.value == value
+                        if t.__class__ is Token
+                        else t == token
+                    ):
+                        break
+                    pos += 1
+            else:
+                (p, pred, _) = match_arg
+                as_value = False
+                while pos < n and pred(tokens[pos]):
+                    pos += 1
+            if pos > start:
+                matched = tokens[start:pos]
+                values[len(values) - 1].extend(
+                    [t.value for t in matched] if as_value else matched
+                )
+                if pos > max_pos:
+                    max_pos = pos
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            continue
+        elif op == PUSH_LIST:
+            values.append([])
+            continue
+        elif op == APPEND:
+            v = values.pop()
+            values[len(values) - 1].append(v)
+            continue
+        elif op == IGNORE:
+            v = values[len(values) - 1]
+            if not isinstance(v, _Ignored):
+                values[len(values) - 1] = _Ignored(v)
+            continue
+        elif op == PURE:
+            values.append(arg)
+            continue
+        elif op == FINISHED:
+            if pos >= n:
+                values.append(None)
+                continue
+            msg = "got unexpected token"
+            if pos == max_pos:
+                expected = arg
+                expected_at = pos
+        elif op == CALL:
+            try:
+                (v, s2) = arg.run(tokens, State(pos, max_pos, expected))
+            except NoParseError as e:
+                msg = e.msg
+                max_pos = e.state.max
+                if e.state.parser is not expected:
+                    expected = e.state.parser
+                    expected_at = max_pos
+            else:
+                values.append(v)
+                pos = s2.pos
+                max_pos = s2.max
+                if s2.parser is not expected:
+                    expected = s2.parser
+                    expected_at = max_pos
+                continue
+        elif op == CALL_MEMO:
+            (rule, address) = arg
+            entry = memo[pos].get(rule)
+            if entry is None:
+                if len(frames) >= max_depth:
+                    raise RecursionError("maximum recursion depth exceeded in a rule")
+                caller = (rule, pc, max_pos, expected, expected_at)
+                frames.append((None, pos, len(values), caller))
+                max_pos = pos
+                expected = None
+                expected_at = -1
+                pc = address
+                continue
+            (ok, v, end, rule_max, rule_expected, rule_expected_at) = entry
+            if rule_expected_at >= max_pos:
+                expected = rule_expected
+                expected_at = rule_expected_at
+            if rule_max > max_pos:
+                max_pos = rule_max
+            if ok:
+                values.append(v)
+                pos = end
+                continue
+            msg = v
+        elif op == CALL_SECTION:
+            if len(frames) >= max_depth:
+                raise RecursionError("maximum recursion depth exceeded in a rule")
+            frames.append((None, pos, 0, pc))
+            pc = arg
+            continue
+        elif op == RETURN_SECTION:
+            pc = frames.pop()[3]
+            continue
+        elif op == RETURN:
+            (_, start, _, (rule, pc, caller_max, caller_expected, caller_at)) = (
+                frames.pop()
+            )
+            memo[start][rule] = (True, values[len(values) - 1], pos, max_pos, expected, expected_at)
+            if expected_at < caller_max:
+                expected = caller_expected
+                expected_at = caller_at
+            if caller_max > max_pos:
+                max_pos = caller_max
+            continue
+        else:
+            return values.pop(), State(pos, max_pos, expected)
+
+        # The opcode failed: backtrack to the innermost alternative left to try
+        while frames:
+            (target, start, depth, failed) = frames.pop()
+            if target is not None:
+                if failed is not None and start == max_pos:
+                    expected = failed
+                    expected_at = start
+                pos = start
+                del values[depth:]
+                pc = target
+                break
+            elif failed.__class__ is int:
+                continue
+            elif failed.__class__ is tuple:
+                (rule, _, caller_max, caller_expected, caller_at) = failed
+                memo[start][rule] = (False, msg, None, max_pos, expected, expected_at)
+                if expected_at < caller_max:
+                    expected = caller_expected
+                    expected_at = caller_at
+                if caller_max > max_pos:
+                    max_pos = caller_max
+            elif start == max_pos:
+                expected = failed
+                expected_at = start
+        else:
+            raise NoParseError(msg, State(pos, max_pos, expected))
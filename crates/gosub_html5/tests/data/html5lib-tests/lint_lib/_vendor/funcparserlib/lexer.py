@@ -24,6 +24,13 @@ from __future__ import unicode_literals
 __all__ = ["make_tokenizer", "TokenSpec", "Token", "LexerError"]
 
 import re
+import sys
+import warnings
+
+if sys.version_info < (3,):
+    string_types = (str, unicode)  # noqa
+else:
+    string_types = str
 
 
 class LexerError(Exception):
@@ -153,25 +160,43 @@ def make_tokenizer(specs):
     compiled = []
     for spec in specs:
         if isinstance(spec, TokenSpec):
-            c = spec.type, re.compile(spec.pattern, spec.flags)
+            regexp = re.compile(spec.pattern, spec.flags)
+            c = spec.type, regexp, _may_match_newline(regexp)
         else:
             name, args = spec
-            c = name, re.compile(*args)
+            regexp = re.compile(*args)
+            c = name, regexp, _may_match_newline(regexp)
         compiled.append(c)
 
+    combined = _combine_specs(compiled)
+
     def match_specs(s, i, position):
         line, pos = position
-        for type, regexp in compiled:
+        m = None
+        if combined is not None:
+            regexp, types = combined
             m = regexp.match(s, i)
             if m is not None:
-                value = m.group()
+                type, has_nl = types[m.lastgroup]
+        else:
+            for type, regexp, has_nl in compiled:
+                m = regexp.match(s, i)
+                if m is not None:
+                    break
+        if m is not None:
+            value = m.group()
+            end = m.end()
+            if not has_nl:
+                n_line = line
+                n_pos = pos + end - i
+            else:
                 nls = value.count("\n")
                 n_line = line + nls
                 if nls == 0:
-                    n_pos = pos + len(value)
+                    n_pos = pos + end - i
                 else:
                     n_pos = len(value) - value.rfind("\n") - 1
-                return Token(type, value, (line, pos + 1), (n_line, n_pos))
+            return Token(type, value, (line, pos + 1), (n_line, n_pos)), end
         else:
             err_line = s.splitlines()[line - 1]
             raise LexerError((line, pos + 1), err_line)
@@ -181,14 +206,66 @@ def make_tokenizer(specs):
         line, pos = 1, 0
         i = 0
         while i < length:
-            t = match_specs(s, i, (line, pos))
+            t, i = match_specs(s, i, (line, pos))
             yield t
             line, pos = t.end
-            i += len(t.value)
 
     return f
 
 
+def _may_match_newline(regexp):
+    """Tell whether the compiled regexp may match a string containing a newline.
+
+    It errs on the side of `True`: only patterns without escapes, negated sets, control
+    characters, or dots that might be in the DOTALL mode are known not to match
+    newlines, which lets the tokenizer skip counting them in the tokens.
+    """
+    pattern = regexp.pattern
+    if not isinstance(pattern, string_types):
+        return True
+    if "\\" in pattern or "[^" in pattern or any(c < " " for c in pattern):
+        return True
+    return "." in pattern and bool(regexp.flags & re.DOTALL or "(?" in pattern)
+
+
+# Backreferences by group number and conditional groups would refer to the wrong
+# groups once the patterns are wrapped into a single alternation.
+_group_number_ref = re.compile(r"\\[1-9]|\(\?\(")
+
+
+def _combine_specs(compiled):
+    """Join the compiled specs into a single regexp trying them in order.
+
+    Return a pair of the combined regexp and a mapping of its group names to the token
+    types and whether they may contain newlines, or `None` if the specs cannot be
+    combined without changing their meaning.
+    """
+    if not compiled:
+        return None
+    flags = compiled[0][1].flags
+    if flags & re.VERBOSE:
+        return None
+    alternatives = []
+    types = {}
+    for i, (type, regexp, has_nl) in enumerate(compiled):
+        pattern = regexp.pattern
+        if (
+            regexp.flags != flags
+            or not isinstance(pattern, string_types)
+            or _group_number_ref.search(pattern)
+        ):
+            return None
+        group = "_spec%d" % i
+        alternatives.append("(?P<%s>%s)" % (group, pattern))
+        types[group] = type, has_nl
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            return re.compile("|".join(alternatives), flags), types
+    except (re.error, Warning):
+        return None
+
+
 # This is an example of token specs. See also [this article][1] for a
 # discussion of searching for multiline comments using regexps (including `*?`).
 #
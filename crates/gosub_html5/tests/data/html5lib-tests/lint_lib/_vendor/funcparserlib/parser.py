@@ -69,8 +69,12 @@ __all__ = [
 ]
 
 import sys
+import functools
 import logging
+import types
 import warnings
+import weakref
+from array import array
 
 from lint_lib._vendor.funcparserlib.lexer import Token
 
@@ -82,6 +86,76 @@ if sys.version_info < (3,):
 else:
     string_types = str
 
+# Kinds of parser nodes, as told apart by the compiler in `Parser._compile()`
+(
+    _K_CALL,
+    _K_REF,
+    _K_SOME,
+    _K_EQ,
+    _K_TYPE,
+    _K_TOKEN,
+    _K_TOK,
+    _K_FINISHED,
+    _K_PURE,
+    _K_SEQ,
+    _K_ALT,
+    _K_SHIFT,
+    _K_IGNORE,
+    _K_MANY,
+    _K_ONEPLUS,
+    _K_MAYBE,
+) = range(16)
+
+# Opcodes of the parsing machine run by `_vm_run()`
+(
+    _MATCH_PRED,
+    _MATCH_EQ,
+    _MATCH_TYPE,
+    _MATCH_TOKEN,
+    _FINISHED,
+    _PURE,
+    _CALL,
+    _CALL_MEMO,
+    _RETURN,
+    _CALL_SECTION,
+    _RETURN_SECTION,
+    _SHIFT,
+    _IGNORE,
+    _PUSH_TUPLE,
+    _ALT,
+    _ALT_FIRST,
+    _ALT_TYPE,
+    _DISPATCH,
+    _DISPATCH_TYPE,
+    _COMMIT,
+    _PUSH_LIST,
+    _APPEND,
+    _MANY,
+    _MATCH_MANY,
+    _END,
+) = range(25)
+
+# The keys of the tokens in the FIRST sets of `_Compiler.first()`: the tokens
+# themselves, their `(type, value)` pairs, or their types
+(
+    _BY_VALUE,
+    _BY_TOKEN,
+    _BY_TYPE,
+) = range(3)
+
+
+# The number of parsers redefined via `Parser.define()` so far, which makes the
+# compiled parsers out of date
+_definitions = 0
+
+# Whether the parsers run the methods logging their runs, as `debug` was when last
+# checked, see `_log_runs()`
+_logging = False
+
+# The parsers defined via `Parser.define()`, which bind the methods of the parser
+# they are defined as
+_defined = weakref.WeakSet()
+
 
 class Parser(object):
     """A parser object that can parse a sequence of tokens or can be combined with
@@ -108,6 +182,12 @@ class Parser(object):
         construct new parsers.
     """
 
+    _kind = _K_CALL
+    # The opcodes compiled by _compile() and the number of definitions they are for
+    _compiled = None
+    # The parser or the function this one is defined as
+    _definition = None
+
     def __init__(self, p):
         """Wrap the parser function `p` into a `Parser` object."""
         self.name = ""
@@ -151,13 +231,38 @@ class Parser(object):
 
         See the examples in the docs for `forward_decl()`.
         """
-        f = getattr(p, "run", p)
-        if debug:
-            setattr(self, "_run", f)
+        if debug != _logging:
+            _log_runs(debug)
+        # Whatever this parser was built by, the compiler now has to go through p. A
+        # parser being built by __init__() isn't part of any compiled parser yet
+        if self._definition is not None:
+            global _definitions
+            _definitions += 1
+        if isinstance(p, Parser):
+            self._kind = _K_REF
+            self.p = p
         else:
-            setattr(self, "run", f)
+            self._kind = _K_CALL
+        self._definition = p
+        self._bind()
+        _defined.add(self)
         self.named(getattr(p, "name", p.__doc__))
 
+    def _bind(self):
+        """Run the parser this one is defined as directly, or via `Parser.run()` if
+        the runs are logged."""
+        p = self._definition
+        f = getattr(p, "run", p)
+        if _logging:
+            self.__dict__.pop("run", None)
+            self._run = f
+        else:
+            self.run = f
+        if isinstance(p, Parser) and not _logging:
+            self._try_run = p._try_run
+        else:
+            self._try_run = types.MethodType(Parser._try_run, self)
+
     def run(self, tokens, s):
         """Run the parser against the tokens with the specified parsing state.
 
@@ -175,13 +280,53 @@ class Parser(object):
             `Parser.parse(tokens)` instead and let the parser object take care of
             updating the parsing state.
         """
-        if debug:
-            log.debug("trying %s" % self.name)
         return self._run(tokens, s)  # noqa
 
+    def _try_run(self, tokens, s):
+        """Run the parser like `Parser.run()`, but return `_FAILED` paired with the
+        state of the failure instead of raising `NoParseError`.
+
+        Type: `(Sequence[A], State) -> Tuple[Union[B, object], State]`
+
+        The parsers combining other ones use it where a failure is not an error, so
+        that trying an alternative or ending a repetition raises nothing.
+        """
+        try:
+            return self.run(tokens, s)
+        except NoParseError as e:
+            return _FAILED, e.state
+
     def _run(self, tokens, s):
         raise NotImplementedError("you must define() a parser")
 
+    def _compile(self, packrat=False):
+        """Compile the parser into a flat array of opcodes for `_vm_run()`.
+
+        Type: `(bool) -> Tuple[array, List[Any]]`
+
+        The operand of each opcode is at the same index in the list of constants.
+        The parsers built by the combinators are laid out in the array one after
+        another, so that only the opaque ones (the parsers wrapping a function,
+        including an undefined `forward_decl()`) are still called via `run()`. The
+        parsers defined via `define()` are laid out once at the end of the array,
+        and jumped to from each place they are used in.
+
+        With `packrat`, these are laid out as rules, and their results are memoized.
+
+        The result is cached until `define()` is called on any parser.
+        """
+        if self._compiled is None or self._compiled[0] != _definitions:
+            self._compiled = (_definitions, {})
+        programs = self._compiled[1]
+        if packrat not in programs:
+            c = _Compiler(packrat)
+            c.share(self)
+            c.emit(self)
+            c.op(_END)
+            c.emit_pending()
+            programs[packrat] = (c.code, c.consts)
+        return programs[packrat]
+
     def parse(self, tokens):
         """Parse the sequence of tokens and return the parsed value.
 
@@ -204,30 +349,92 @@ class Parser(object):
             (as `Token` objects contain their position in the source file) and good
             separation of the lexical and syntactic levels of the grammar.
         """
+        return self._parse(tokens, False, _vm_run)
+
+    def parse_fast(self, tokens):
+        """Parse the sequence of tokens like `Parser.parse()`, running the compiled
+        parser in C if the `_vm` extension module has been built from `_vm.pyx`.
+
+        Type: `(Sequence[A]) -> B`
+
+        Without the extension module it is the same as `Parser.parse()`.
+
+        Examples:
+
+        ```pycon
+        >>> expr = many(a("x")) + a("y")
+        >>> expr.parse_fast("xxxy")
+        (['x', 'x', 'x'], 'y')
+        >>> expr.parse_fast("xxz")
+        Traceback (most recent call last):
+            ...
+        parser.NoParseError: got unexpected token: 'z', expected: 'y'
+        >>> expr = oneplus(tok("number")) + maybe(tok("op", "+"))
+        >>> expr.parse_fast([Token("number", "1"), Token("number", "2")])
+        (['1', '2'], None)
+        >>> expr = forward_decl()
+        >>> expr.define(a("(") + maybe(expr) + a(")"))
+        >>> expr.parse_fast("(())")
+        ('(', ('(', None, ')'), ')')
+
+        ```
+        """
+        return self._parse(tokens, False, _fast_vm_run)
+
+    def parse_packrat(self, tokens):
+        """Parse the sequence of tokens like `Parser.parse()`, memoizing the results
+        of the recursive rules of the grammar.
+
+        Type: `(Sequence[A]) -> B`
+
+        Each parser defined via `p.define(...)`, such as a `forward_decl()`, is run at
+        most once at each position of the sequence. Running it there again takes its
+        result from a cache, so the grammars where alternatives start with the same
+        rules are parsed in linear time instead of exponential time. The cache
+        takes memory proportional to the number of tokens.
+
+        The result is the same as the one of `Parser.parse()`, as long as the parsers
+        wrapping a function don't depend on anything but the position in the
+        sequence.
+
+        Examples:
+
+        ```pycon
+        >>> expr = forward_decl()
+        >>> expr.define(
+        ...     a("(") + expr + a(")") + a("!")
+        ...     | a("(") + expr + a(")")
+        ...     | a("x")
+        ... )
+        >>> expr.parse_packrat("((x))")
+        ('(', ('(', 'x', ')'), ')')
+        >>> expr.parse_packrat("((x)")
+        Traceback (most recent call last):
+            ...
+        parser.NoParseError: got unexpected end of input, expected: ')'
+
+        ```
+        """
+        return self._parse(tokens, True, _vm_run)
+
+    def _parse(self, tokens, packrat, vm_run):
+        if debug != _logging:
+            _log_runs(debug)
         try:
-            (tree, _) = self.run(tokens, State(0, 0, None))
+            if debug:
+                (tree, _) = self.run(tokens, State(0, 0, None))
+            else:
+                code, consts = self._compile(packrat)
+                memo = [{} for _ in range(len(tokens) + 1)] if packrat else None
+                (tree, _) = vm_run(code, consts, tokens, State(0, 0, None), memo)
             return tree
         except NoParseError as e:
+            # The message is only formatted if it's used, as the error may well be
+            # caught and dropped
             max = e.state.max
-            if len(tokens) > max:
-                t = tokens[max]
-                if isinstance(t, Token):
-                    if t.start is None or t.end is None:
-                        loc = ""
-                    else:
-                        s_line, s_pos = t.start
-                        e_line, e_pos = t.end
-                        loc = "%d,%d-%d,%d: " % (s_line, s_pos, e_line, e_pos)
-                    msg = "%s%s: %r" % (loc, e.msg, t.value)
-                elif isinstance(t, string_types):
-                    msg = "%s: %r" % (e.msg, t)
-                else:
-                    msg = "%s: %s" % (e.msg, t)
-            else:
-                msg = "got unexpected end of input"
-            if e.state.parser is not None:
-                msg = "%s, expected: %s" % (msg, e.state.parser.name)
-            e.msg = msg
+            t = tokens[max] if len(tokens) > max else _END_OF_INPUT
+            name = None if e.state.parser is None else e.state.parser.name
+            e._msg_fn = functools.partial(_error_message, e.msg, t, name)
             raise
 
     def __add__(self, other):
@@ -280,30 +487,7 @@ class Parser(object):
 
         ```
         """
-
-        def magic(v1, v2):
-            if isinstance(v1, _Tuple):
-                return _Tuple(v1 + (v2,))
-            else:
-                return _Tuple((v1, v2))
-
-        @_TupleParser
-        def _add(tokens, s):
-            (v1, s2) = self.run(tokens, s)
-            (v2, s3) = other.run(tokens, s2)
-            return magic(v1, v2), s3
-
-        @Parser
-        def ignored_right(tokens, s):
-            v, s2 = self.run(tokens, s)
-            _, s3 = other.run(tokens, s2)
-            return v, s3
-
-        name = "(%s, %s)" % (self.name, other.name)
-        if isinstance(other, _IgnoredParser):
-            return ignored_right.named(name)
-        else:
-            return _add.named(name)
+        return _SeqNode(self, other)
 
     def __or__(self, other):
         """Choice combination of parsers.
@@ -326,22 +510,7 @@ class Parser(object):
 
         ```
         """
-
-        @Parser
-        def _or(tokens, s):
-            try:
-                return self.run(tokens, s)
-            except NoParseError as e:
-                state = e.state
-            try:
-                return other.run(tokens, State(s.pos, state.max, state.parser))
-            except NoParseError as e:
-                if s.pos == e.state.max:
-                    e.state = State(e.state.pos, e.state.max, _or)
-                raise
-
-        _or.name = "%s or %s" % (self.name, other.name)
-        return _or
+        return _AltNode(self, other)
 
     def __rshift__(self, f):
         """Transform the parsing result by applying the specified function.
@@ -364,13 +533,7 @@ class Parser(object):
 
         ```
         """
-
-        @Parser
-        def _shift(tokens, s):
-            (v, s2) = self.run(tokens, s)
-            return f(v), s2
-
-        return _shift.named(self.name)
+        return _ShiftNode(self, f)
 
     def bind(self, f):
         """Bind the parser to a monadic function that returns a new parser.
@@ -470,6 +633,8 @@ class State(object):
     position `max` of the rightmost token that has been consumed while parsing.
     """
 
+    __slots__ = ("pos", "max", "parser")
+
     def __init__(self, pos, max, parser=None):
         self.pos = pos
         self.max = max
@@ -483,13 +648,60 @@ class State(object):
 
 
 class NoParseError(Exception):
+    __slots__ = ("_msg", "_msg_fn", "state")
+
     def __init__(self, msg, state):
-        self.msg = msg
+        self._msg = msg
+        self._msg_fn = None
         self.state = state
 
+    @property
+    def msg(self):
+        if self._msg_fn is not None:
+            self._msg = self._msg_fn()
+            self._msg_fn = None
+        return self._msg
+
+    @msg.setter
+    def msg(self, msg):
+        self._msg = msg
+        self._msg_fn = None
+
     def __str__(self):
         return self.msg
 
+    def __reduce__(self):
+        return NoParseError, (self.msg, self.state)
+
+
+# The value returned by `Parser._try_run()` when the parser fails
+_FAILED = object()
+
+# The token the parsing failed on when it failed at the end of the input
+_END_OF_INPUT = object()
+
+
+def _error_message(msg, t, name):
+    """Return the message of the error `msg` raised by `Parser.parse()` on the token
+    `t`, the parser named `name` being expected."""
+    if t is _END_OF_INPUT:
+        msg = "got unexpected end of input"
+    elif isinstance(t, Token):
+        if t.start is None or t.end is None:
+            loc = ""
+        else:
+            s_line, s_pos = t.start
+            e_line, e_pos = t.end
+            loc = "%d,%d-%d,%d: " % (s_line, s_pos, e_line, e_pos)
+        msg = "%s%s: %r" % (loc, msg, t.value)
+    elif isinstance(t, string_types):
+        msg = "%s: %r" % (msg, t)
+    else:
+        msg = "%s: %s" % (msg, t)
+    if name is not None:
+        msg = "%s, expected: %s" % (msg, name)
+    return msg
+
 
 class _Tuple(tuple):
     pass
@@ -510,18 +722,1148 @@ class _Ignored(object):
         return isinstance(other, _Ignored) and self.value == other.value
 
 
-@Parser
-def finished(tokens, s):
+def _seq_value(values, kept):
+    """Return the parsed value of `p1 + p2 + ... + pN` given the values of its parts
+    and the indices of the parts that are not ignored."""
+    if not kept:
+        return values[-1]
+    elif len(kept) == 1:
+        return values[kept[0]]
+    # A _Tuple value is extended by the values after it. The items are collected in
+    # a list, so that the _Tuple passed on to `>> f` is the only copy made of them
+    v = values[kept[0]]
+    if v.__class__ is not _Tuple:
+        if len(kept) == len(values):
+            return _Tuple(values)
+        return _Tuple([values[i] for i in kept])
+    items = list(v)
+    items.extend([values[i] for i in kept[1:]])
+    return _Tuple(items)
+
+
+def _seq_kept(parts):
+    """Return the indices of the parts of a sequence that are not ignored."""
+    return tuple(i for i, p in enumerate(parts) if not isinstance(p, _IgnoredParser))
+
+
+def _seq_parts(p):
+    """Return the parts of `p1 + p2 + ... + pN`, which is nested to the left."""
+    parts = [p.right]
+    p = p.left
+    while p._kind == _K_SEQ:
+        parts.append(p.right)
+        p = p.left
+    parts.append(p)
+    parts.reverse()
+    return parts
+
+
+class _SeqNode(_TupleParser):
+    _kind = _K_SEQ
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.name = "(%s, %s)" % (left.name, right.name)
+
+    def run(self, tokens, s):
+        parts = self._parts()
+        values = []
+        for part in parts:
+            (v, s) = part.run(tokens, s)
+            values.append(v)
+        return _seq_value(values, _seq_kept(parts)), s
+
+    def _try_run(self, tokens, s):
+        parts = self._parts()
+        values = []
+        for part in parts:
+            (v, s) = part._try_run(tokens, s)
+            if v is _FAILED:
+                return v, s
+            values.append(v)
+        return _seq_value(values, _seq_kept(parts)), s
+
+    def _parts(self):
+        return _seq_parts(self)
+
+    def _logged_parts(self):
+        p = self
+        while p._kind == _K_SEQ:
+            log.debug("trying %s" % p.name)
+            p = p.left
+        return _seq_parts(self)
+
+
+class _AltNode(Parser):
+    _kind = _K_ALT
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.name = "%s or %s" % (left.name, right.name)
+
+    def run(self, tokens, s):
+        (v, state) = self.left._try_run(tokens, s)
+        if v is not _FAILED:
+            return v, state
+        try:
+            return self.right.run(tokens, State(s.pos, state.max, state.parser))
+        except NoParseError as e:
+            if s.pos == e.state.max:
+                e.state = State(e.state.pos, e.state.max, self)
+            raise
+
+    def _try_run(self, tokens, s):
+        (v, state) = self.left._try_run(tokens, s)
+        if v is not _FAILED:
+            return v, state
+        (v, state) = self.right._try_run(
+            tokens, State(s.pos, state.max, state.parser)
+        )
+        if v is _FAILED and s.pos == state.max:
+            state = State(state.pos, state.max, self)
+        return v, state
+
+
+class _ShiftNode(Parser):
+    _kind = _K_SHIFT
+
+    def __init__(self, p, f):
+        self.p = p
+        self.f = f
+        self.name = p.name
+
+    def run(self, tokens, s):
+        (v, s2) = self.p.run(tokens, s)
+        return self.f(v), s2
+
+    def _try_run(self, tokens, s):
+        (v, s2) = self.p._try_run(tokens, s)
+        if v is _FAILED:
+            return v, s2
+        return self.f(v), s2
+
+
+class _ManyNode(Parser):
+    _kind = _K_MANY
+
+    def __init__(self, p):
+        self.p = p
+        self.name = "{ %s }" % p.name
+
+    def run(self, tokens, s):
+        res = []
+        while True:
+            (v, s2) = self.p._try_run(tokens, s)
+            if v is _FAILED:
+                break
+            res.append(v)
+            s = s2
+        return res, State(s.pos, s2.max, s2.parser)
+
+    _try_run = run
+
+    def _logged_run(self, tokens, s):
+        log.debug("trying %s" % self.name)
+        res = []
+        while True:
+            (v, s2) = self.p._try_run(tokens, s)
+            if v is _FAILED:
+                break
+            res.append(v)
+            s = s2
+        s2 = State(s.pos, s2.max, s2.parser)
+        log.debug(
+            "*matched* %d instances of %s, new state = %s" % (len(res), self.name, s2)
+        )
+        return res, s2
+
+
+class _OnePlusNode(Parser):
+    _kind = _K_ONEPLUS
+
+    def __init__(self, p):
+        self.p = p
+        self.many = _ManyNode(p)
+        self.name = "(%s, { %s })" % (p.name, p.name)
+
+    def run(self, tokens, s):
+        (v1, s2) = self.p.run(tokens, s)
+        (v2, s3) = self.many.run(tokens, s2)
+        return [v1] + v2, s3
+
+    def _try_run(self, tokens, s):
+        (v1, s2) = self.p._try_run(tokens, s)
+        if v1 is _FAILED:
+            return v1, s2
+        (v2, s3) = self.many.run(tokens, s2)
+        return [v1] + v2, s3
+
+
+class _MaybeNode(Parser):
+    """The parser `p | pure(None)` built by `maybe()`."""
+
+    _kind = _K_MAYBE
+
+    def __init__(self, p):
+        self.p = p
+        self.name = "[ %s ]" % (p.name,)
+
+    def run(self, tokens, s):
+        (v, s2) = self.p._try_run(tokens, s)
+        if v is _FAILED:
+            return None, State(s.pos, s2.max, s2.parser)
+        return v, s2
+
+    _try_run = run
+
+
+class _SomeParser(Parser):
+    _kind = _K_SOME
+
+    def __init__(self, pred):
+        self.pred = pred
+        self.name = "some(...)"
+
+    def run(self, tokens, s):
+        pos = s.pos
+        max_pos = s.max
+        if pos >= len(tokens):
+            s2 = State(pos, max_pos, self if pos == max_pos else s.parser)
+            raise NoParseError("got unexpected end of input", s2)
+        else:
+            t = tokens[pos]
+            if self.pred(t):
+                pos += 1
+                return t, State(pos, pos if pos > max_pos else max_pos, s.parser)
+            else:
+                s2 = State(pos, max_pos, self if pos == max_pos else s.parser)
+                raise NoParseError("got unexpected token", s2)
+
+    def _logged_run(self, tokens, s):
+        log.debug("trying %s" % self.name)
+        pos = s.pos
+        max_pos = s.max
+        if pos >= len(tokens):
+            s2 = State(pos, max_pos, self if pos == max_pos else s.parser)
+            raise NoParseError("got unexpected end of input", s2)
+        else:
+            t = tokens[pos]
+            if self.pred(t):
+                pos += 1
+                s2 = State(pos, pos if pos > max_pos else max_pos, s.parser)
+                log.debug("*matched* %r, new state = %s" % (t, s2))
+                return t, s2
+            else:
+                s2 = State(pos, max_pos, self if pos == max_pos else s.parser)
+                log.debug(
+                    "failed %r, state = %s, expected = %s" % (t, s2, s2.parser.name)
+                )
+                raise NoParseError("got unexpected token", s2)
+
+    def _try_run(self, tokens, s):
+        pos = s.pos
+        max_pos = s.max
+        if pos < len(tokens):
+            t = tokens[pos]
+            if self.pred(t):
+                pos += 1
+                return t, State(pos, pos if pos > max_pos else max_pos, s.parser)
+        return _FAILED, State(pos, max_pos, self if pos == max_pos else s.parser)
+
+
+class _EqParser(_SomeParser):
+    _kind = _K_EQ
+
+    def __init__(self, value):
+        self.value = value
+        self.name = "some(...)"
+
+    def pred(self, t):
+        return t == self.value
+
+
+class _TokExactParser(_SomeParser):
+    """The parser `a(token)` of a `Token`, comparing the type and the value of the
+    tokens rather than calling `Token.__eq__()`."""
+
+    _kind = _K_TOKEN
+
+    def __init__(self, token):
+        self.token = token
+        self.type = token.type
+        self.value = token.value
+        self.name = "some(...)"
+
+    def pred(self, t):
+        if t.__class__ is Token:
+            return t.type == self.type and t.value == self.value
+        return t == self.token
+
+
+class _TokTypeParser(_SomeParser):
+    _kind = _K_TYPE
+
+    def __init__(self, type):
+        self.type = type
+        self.name = type
+
+    def pred(self, t):
+        return t.type == self.type
+
+
+class _TokParser(Parser):
+    """The parser `p >> (lambda t: t.value)` built by `tok()`, `p` being the one to
+    expect if it fails."""
+
+    _kind = _K_TOK
+
+    def __init__(self, p):
+        self.p = p
+        self.name = p.name
+
+    def run(self, tokens, s):
+        (t, s2) = self.p.run(tokens, s)
+        return t.value, s2
+
+    def _try_run(self, tokens, s):
+        (t, s2) = self.p._try_run(tokens, s)
+        if t is _FAILED:
+            return t, s2
+        return t.value, s2
+
+
+class _PureParser(Parser):
+    _kind = _K_PURE
+
+    def __init__(self, x):
+        self.value = x
+        self.name = "(pure %r)" % (x,)
+
+    def run(self, tokens, s):
+        return self.value, s
+
+
+class _FinishedParser(Parser):
     """A parser that throws an exception if there are any unparsed tokens left in the
     sequence."""
-    if s.pos >= len(tokens):
-        return None, s
-    else:
-        s2 = State(s.pos, s.max, finished if s.pos == s.max else s.parser)
-        raise NoParseError("got unexpected token", s2)
+
+    _kind = _K_FINISHED
+
+    def __init__(self):
+        self.name = "end of input"
+
+    def run(self, tokens, s):
+        pos = s.pos
+        if pos >= len(tokens):
+            return None, s
+        else:
+            s2 = State(pos, s.max, self if pos == s.max else s.parser)
+            raise NoParseError("got unexpected token", s2)
+
+
+class _Compiler(object):
+    """Lays out the opcodes of a parser and the parsers it's built of for
+    `_vm_run()`, see `Parser._compile()`."""
+
+    # The smallest parser laid out as a section if it is used in several places
+    min_section_size = 16
+
+    def __init__(self, packrat=False):
+        self.code = array("i")
+        self.consts = []
+        self.packrat = packrat
+        # The parsers laid out as sections called via _CALL_SECTION, see share()
+        self.shared = set()
+        # The addresses of the rules called via _CALL_MEMO and of the sections, once
+        # laid out
+        self.addresses = {}
+        self.pending = []
+
+    def op(self, opcode, arg=None):
+        self.code.append(opcode)
+        self.consts.append(arg)
+        return len(self.code) - 1
+
+    def emit(self, p, inline=False):
+        if p in self.shared and not inline:
+            if p not in self.addresses:
+                self.addresses[p] = None
+                self.pending.append(p)
+            self.op(_CALL_SECTION, p)
+            return
+        kind = p._kind
+        match = self.match(p)
+        if match is not None:
+            self.op(*match)
+        elif kind == _K_SEQ:
+            (units, then) = self.seq_units(p)
+            for unit in units:
+                self.emit(unit)
+            self.op(*then)
+        elif kind == _K_ALT:
+            self.emit_choice(
+                [self.unfold(alt, failed) for alt, failed in self.alternatives(p)]
+            )
+        elif kind == _K_SHIFT:
+            self.emit(p.p)
+            self.op(_SHIFT, p.f)
+        elif kind == _K_IGNORE:
+            self.emit(p.p)
+            self.op(_IGNORE)
+        elif kind == _K_MANY or kind == _K_ONEPLUS:
+            self.op(_PUSH_LIST)
+            if kind == _K_ONEPLUS:
+                self.emit(p.p)
+                self.op(_APPEND)
+            match = self.match(p.p)
+            if match is not None:
+                # The tokens matched one by one are consumed in a single scan
+                self.op(_MATCH_MANY, match)
+            else:
+                loop = self.op(_ALT)
+                self.emit(p.p)
+                self.op(_MANY, loop)
+                self.consts[loop] = (len(self.code), None)
+        elif kind == _K_MAYBE:
+            match = self.match(p.p, optional=True)
+            if match is not None:
+                self.op(*match)
+            else:
+                # Like p | pure(None), but pure(None) needs no choice frame as it
+                # can't fail
+                at = self.op(_ALT)
+                self.emit(p.p)
+                commit = self.op(_COMMIT)
+                self.try_op(at, self.first(p.p), len(self.code), None)
+                self.op(_PURE, None)
+                self.consts[commit] = len(self.code)
+        elif kind == _K_PURE:
+            self.op(_PURE, p.value)
+        elif kind == _K_FINISHED:
+            self.op(_FINISHED, p)
+        elif kind == _K_REF:
+            if p not in self.addresses:
+                self.addresses[p] = None
+                self.pending.append(p)
+            self.op(_CALL_MEMO if self.packrat else _CALL_SECTION, p)
+        else:
+            self.op(_CALL, p)
+
+    def seq_units(self, p):
+        """Return the parsers laid out one after another for `p1 + p2 + ... + pN`
+        and the opcode combining their values in one go."""
+        parts = _seq_parts(p)
+        kept = _seq_kept(parts)
+        # The value of an ignored part is dropped unless all of them are, so there
+        # is no need to wrap it in _Ignored
+        units = [part.p if kept and part._kind == _K_IGNORE else part for part in parts]
+        return units, (_PUSH_TUPLE, (len(parts), kept))
+
+    def unfold(self, p, failed):
+        """Return the alternative `p` of a choice as `(units, then, failed)`: the
+        parsers laid out one after another for it, then the opcode combining their
+        values if any, and the choice parser expected when it fails, see
+        `emit_choice()`."""
+        if p._kind == _K_SEQ and p not in self.shared:
+            (units, then) = self.seq_units(p)
+            return units, then, failed
+        return [p], None, failed
+
+    def emit_choice(self, alts):
+        """Lay out the alternatives `(units, then, failed)` of a choice, where
+        `then` is an opcode run after the units, or the alternatives to choose from
+        after them, see `factor()`."""
+        # The alternatives known to start with one of a few tokens are only tried
+        # on these tokens. The other ones are tried one after another
+        alts = self.factor(alts)
+        firsts = self.unify(
+            [self.first(units[0]) if units else None for units, _, _ in alts]
+        )
+        keyed = len(alts) - firsts.count(None)
+        dispatch = self.op(_DISPATCH) if keyed > 1 else None
+        starts = []
+        commits = []
+        for i, ((units, then, failed), first) in enumerate(zip(alts, firsts)):
+            last = i + 1 == len(alts)
+            if last and failed is None:
+                # Nothing is left to try nor to report when it fails
+                at = None
+                starts.append(len(self.code))
+            else:
+                at = self.op(_ALT)
+                starts.append(at)
+            for unit in units:
+                self.emit(unit)
+            if then.__class__ is list:
+                self.emit_choice(then)
+            elif then is not None:
+                self.op(*then)
+            if at is None:
+                continue
+            commits.append(self.op(_COMMIT))
+            self.try_op(at, first, None if last else len(self.code), failed)
+        for at in commits:
+            self.consts[at] = len(self.code)
+        if dispatch is not None:
+            labels = [failed for _, _, failed in alts]
+            self.dispatch_op(dispatch, labels, firsts, starts)
+
+    def try_op(self, at, first, next_alt, failed):
+        """Make the opcode at `at` push the frame of an alternative starting with
+        the tokens `first`, to go on with `next_alt` if it fails. The alternative is
+        skipped on the other tokens, see `first()`."""
+        if first is None:
+            self.code[at] = _ALT
+            self.consts[at] = (next_alt, failed)
+            return
+        (keys, by, reporter) = first
+        skipped = reporter if failed is None else failed
+        if by == _BY_TYPE:
+            self.code[at] = _ALT_TYPE
+            self.consts[at] = (next_alt, failed, keys, skipped)
+        else:
+            self.code[at] = _ALT_FIRST
+            self.consts[at] = (next_alt, failed, keys, by == _BY_TOKEN, skipped)
+
+    def factor(self, alts):
+        """Left-factor the alternatives of a choice: the ones in a row starting with
+        the same single token parsers become one alternative parsing these tokens
+        once, then choosing between the rest of each of them.
+
+        `(a("x") + a("y")) | (a("x") + a("z"))` is laid out as `a("x") + (a("y") |
+        a("z"))` would be, but with the values of the original alternatives. It's
+        only done for parsers of single tokens, as parsing them again in the next
+        alternative can't affect the parsing state the way other parsers might.
+        """
+        factored = []
+        i = 0
+        while i < len(alts):
+            k = len(alts[i][0])
+            j = i + 1
+            while j < len(alts):
+                n = self.common_prefix(alts[i][0], alts[j][0])
+                if n == 0:
+                    break
+                k = min(k, n)
+                j += 1
+            if j - i < 2:
+                factored.append(alts[i])
+                i += 1
+                continue
+            # The tokens are parsed by the units of the last alternative, which are
+            # the ones expected if they fail
+            (units, _, failed) = alts[j - 1]
+            log.debug(
+                "left-factoring %s out of %d alternatives"
+                % (" + ".join(unit.name for unit in units[:k]), j - i)
+            )
+            rests = [(units[k:], then, None) for units, then, _ in alts[i:j]]
+            factored.append((units[:k], rests, failed))
+            i = j
+        return factored
+
+    def common_prefix(self, units1, units2):
+        """Return the number of the same single token parsers that both `units1`
+        and `units2` start with."""
+        n = 0
+        for p1, p2 in zip(units1, units2):
+            match1 = self.match(p1)
+            match2 = self.match(p2)
+            if match1 is None or match2 is None or match1[0] != match2[0]:
+                break
+            (q1, value1) = (match1[1][0], match1[1][1])
+            (q2, value2) = (match2[1][0], match2[1][1])
+            if q1 is not q2 and (
+                q1.name != q2.name
+                or type(value1) is not type(value2)
+                or value1 != value2
+                or match1[1][2:] != match2[1][2:]
+            ):
+                break
+            n += 1
+        return n
+
+    def match(self, p, optional=False):
+        """Return the opcode and its argument matching a single token if `p` is a
+        parser of a single token, or `None` otherwise.
+
+        With `optional`, the opcode returns `None` instead of failing, like
+        `maybe(p)`.
+        """
+        kind = p._kind
+        if kind == _K_SOME:
+            return _MATCH_PRED, (p, p.pred, optional)
+        elif kind == _K_EQ:
+            return _MATCH_EQ, (p, p.value, False, optional)
+        elif kind == _K_TYPE:
+            return _MATCH_TYPE, (p, p.type, False, optional)
+        elif kind == _K_TOKEN:
+            return _MATCH_TOKEN, (p, p.type, p.value, p.token, False, optional)
+        elif kind == _K_TOK and p.p._kind == _K_EQ:
+            return _MATCH_EQ, (p.p, p.p.value, True, optional)
+        elif kind == _K_TOK and p.p._kind == _K_TYPE:
+            return _MATCH_TYPE, (p.p, p.p.type, True, optional)
+        elif kind == _K_TOK and p.p._kind == _K_TOKEN:
+            q = p.p
+            return _MATCH_TOKEN, (q, q.type, q.value, q.token, True, optional)
+        return None
+
+    def emit_pending(self):
+        """Lay out the rules called via `_CALL_MEMO` and the sections called via
+        `_CALL_SECTION` after the code calling them, then point the calls at them.
+
+        Without packrat, the parsers defined via `define()` are sections too.
+        """
+        while self.pending:
+            p = self.pending.pop()
+            self.addresses[p] = len(self.code)
+            if p in self.shared:
+                self.emit(p, inline=True)
+                self.op(_RETURN_SECTION)
+            else:
+                self.emit(p.p)
+                self.op(_RETURN if self.packrat else _RETURN_SECTION)
+        for i, opcode in enumerate(self.code):
+            if opcode == _CALL_MEMO:
+                self.consts[i] = (self.consts[i], self.addresses[self.consts[i]])
+            elif opcode == _CALL_SECTION:
+                self.consts[i] = self.addresses[self.consts[i]]
+
+    def share(self, p):
+        """Find the parsers that `p` uses in several places and that are big enough
+        to be laid out once, as a section called from each of these places, rather
+        than copied into each of them.
+
+        Only the same parser objects are shared, as the parsers built separately
+        can be renamed separately.
+        """
+        uses = {}
+        sizes = {}
+        stack = [p]
+        seen = set(stack)
+        while stack:
+            q = stack.pop()
+            children = self.children(q)
+            if q._kind == _K_REF:
+                # The body of a defined parser is laid out on its own
+                children = [q.p]
+            else:
+                for child in children:
+                    uses[child] = uses.get(child, 0) + 1
+            for child in children:
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+
+        def size(q):
+            n = sizes.get(q)
+            if n is None:
+                n = 1 + sum(size(child) for child in self.children(q))
+                sizes[q] = n
+            return n
+
+        for q, n in uses.items():
+            if n > 1 and self.children(q) and size(q) >= self.min_section_size:
+                self.shared.add(q)
+
+    def children(self, p):
+        """Return the parsers that `emit()` lays out as part of `p`."""
+        kind = p._kind
+        if kind == _K_SEQ:
+            return _seq_parts(p)
+        elif kind == _K_ALT:
+            return [alt for alt, _ in self.alternatives(p)]
+        elif (
+            kind == _K_SHIFT
+            or kind == _K_IGNORE
+            or kind == _K_MANY
+            or kind == _K_ONEPLUS
+            or kind == _K_MAYBE
+        ):
+            return [p.p]
+        return []
+
+    def first(self, p):
+        """Return the keys of the tokens `p` can start with as `(keys, by, parser)`,
+        or `None` if it can start with any token or parse no tokens at all.
+
+        The keys are the tokens themselves, their `(type, value)` pairs or their
+        types, as told by `by`. On any other token `p` fails right away, the parser
+        to expect being `parser`.
+        """
+        kind = p._kind
+        if kind == _K_EQ:
+            value = p.value
+            try:
+                if isinstance(value, Token):
+                    return frozenset([(value.type, value.value)]), _BY_TOKEN, p
+                return frozenset([value]), _BY_VALUE, p
+            except TypeError:
+                return None
+        elif kind == _K_TOKEN:
+            try:
+                return frozenset([(p.type, p.value)]), _BY_TOKEN, p
+            except TypeError:
+                return None
+        elif kind == _K_TYPE:
+            try:
+                return frozenset([p.type]), _BY_TYPE, p
+            except TypeError:
+                return None
+        elif (
+            kind == _K_TOK
+            or kind == _K_SHIFT
+            or kind == _K_IGNORE
+            or kind == _K_ONEPLUS
+        ):
+            return self.first(p.p)
+        elif kind == _K_SEQ:
+            while p._kind == _K_SEQ:
+                p = p.left
+            return self.first(p)
+        elif kind == _K_ALT:
+            firsts = self.unify([self.first(alt) for alt, _ in self.alternatives(p)])
+            if None in firsts:
+                return None
+            return frozenset().union(*[first[0] for first in firsts]), firsts[0][1], p
+        return None
+
+    def unify(self, firsts):
+        """Return the FIRST sets keyed the same way: by type if some of them are
+        keyed by type and the other ones by `(type, value)` pairs. If they can't be,
+        none of them are used."""
+        by = set(first[1] for first in firsts if first is not None)
+        if by == set([_BY_TOKEN, _BY_TYPE]):
+            return [
+                (frozenset(key[0] for key in first[0]), _BY_TYPE, first[2])
+                if first is not None and first[1] == _BY_TOKEN
+                else first
+                for first in firsts
+            ]
+        elif len(by) > 1:
+            return [None] * len(firsts)
+        return firsts
+
+    def dispatch_op(self, at, labels, firsts, starts):
+        """Make the opcode at `at` jump to the first of the alternatives starting at
+        `starts` that isn't sure to fail on the next token, see `first()`.
+
+        Its argument is the alternative to jump to for each key and for the other
+        tokens, and the parser to expect after skipping the alternatives before it.
+        The alternatives with the same key are then tried in order from there.
+        """
+        by = [first for first in firsts if first is not None][0][1]
+
+        def target(key):
+            skipped = None
+            for failed, first, start in zip(labels, firsts, starts):
+                if first is None or key in first[0]:
+                    return start, skipped
+                skipped = first[2] if failed is None else failed
+            return None, skipped
+
+        table = {}
+        for first in firsts:
+            if first is not None:
+                for key in first[0]:
+                    if key not in table:
+                        table[key] = target(key)
+        if by == _BY_TYPE:
+            self.code[at] = _DISPATCH_TYPE
+            self.consts[at] = (table, target(_NO_KEY))
+        else:
+            self.code[at] = _DISPATCH
+            self.consts[at] = (by == _BY_TOKEN, table, target(_NO_KEY))
+
+    def alternatives(self, p):
+        """Return the alternatives of `p1 | p2 | ... | pN` paired with the choice
+        parser (if any) that is expected when each of them fails at the position of
+        the rightmost consumed token."""
+        if p._kind != _K_ALT:
+            return [(p, None)]
+        alts = self.alternatives(p.left) + self.alternatives(p.right)
+        alts[-1] = (alts[-1][0], p)
+        return alts
+
+
+_NO_KEY = object()
+
+
+def _vm_run(code, consts, tokens, s, memo=None):
+    """Run the opcodes compiled by `Parser._compile()` against the tokens with the
+    specified parsing state.
+
+    Type: `(array, List[Any], Sequence[A], State, Optional[List[dict]]) ->
+    Tuple[B, State]`
+
+    It runs in a single loop: the parsing state is kept in local variables, the
+    parsed values on a stack, and the alternatives to backtrack to on another stack
+    of `(address, pos, depth, parser)` frames. The sections called via
+    `_CALL_SECTION` keep the address to return to on that stack too. As they may
+    call each other recursively, too many frames raise `RecursionError` like too
+    many nested calls of `run()` would.
+
+    The results of the rules called via `_CALL_MEMO` are kept in `memo`, a dict per
+    position. A rule is run as if nothing had been consumed before its position,
+    and `expected_at` tracks where the parser to expect was last set. Since it can
+    only be set at the rightmost position consumed so far, the parser to expect
+    after the rule is the one it set if it did so at or after the rightmost
+    position consumed before it, or the one before it otherwise.
+    """
+    # Each opcode is fetched along with its argument in one go
+    program = list(zip(code, consts))
+    n = len(tokens)
+    pos = s.pos
+    max_pos = s.max
+    expected = s.parser
+    expected_at = -1
+    msg = None
+    values = []
+    frames = []
+    max_depth = sys.getrecursionlimit()
+    pc = 0
+    while True:
+        (op, arg) = program[pc]
+        pc += 1
+        if op == _MATCH_PRED:
+            (p, pred, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if pred(t):
+                    values.append(t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == _MATCH_EQ:
+            (p, value, as_value, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if t == value:
+                    values.append(t.value if as_value else t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == _MATCH_TYPE:
+            (p, type, as_value, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if t.type == type:
+                    values.append(t.value if as_value else t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == _MATCH_TOKEN:
+            (p, type, value, token, as_value, optional) = arg
+            if pos < n:
+                t = tokens[pos]
+                if (
+                    t.type == type and t.value == value
+                    if t.__class__ is Token
+                    else t == token
+                ):
+                    values.append(t.value if as_value else t)
+                    pos += 1
+                    if pos > max_pos:
+                        max_pos = pos
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            if optional:
+                values.append(None)
+                continue
+        elif op == _PUSH_TUPLE:
+            (k, kept) = arg
+            parts = values[-k:]
+            del values[-k:]
+            values.append(_seq_value(parts, kept))
+            continue
+        elif op == _ALT:
+            frames.append((arg[0], pos, len(values), arg[1]))
+            continue
+        elif op == _ALT_FIRST:
+            # Skip the alternative if it is sure to fail on the next token, as if
+            # it had been tried
+            (next_alt, failed, keys, by_token, skipped) = arg
+            if pos < n:
+                t = tokens[pos]
+                try:
+                    found = ((t.type, t.value) if by_token else t) in keys
+                except (AttributeError, TypeError):
+                    found = True
+                if found:
+                    frames.append((next_alt, pos, len(values), failed))
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if next_alt is not None:
+                pc = next_alt
+                continue
+        elif op == _ALT_TYPE:
+            (next_alt, failed, keys, skipped) = arg
+            if pos < n:
+                try:
+                    found = tokens[pos].type in keys
+                except (AttributeError, TypeError):
+                    found = True
+                if found:
+                    frames.append((next_alt, pos, len(values), failed))
+                    continue
+                msg = "got unexpected token"
+            else:
+                msg = "got unexpected end of input"
+            if pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if next_alt is not None:
+                pc = next_alt
+                continue
+        elif op == _DISPATCH:
+            (by_token, table, other) = arg
+            if pos < n:
+                t = tokens[pos]
+                try:
+                    (target, skipped) = table.get(
+                        (t.type, t.value) if by_token else t, other
+                    )
+                except (AttributeError, TypeError):
+                    continue
+                msg = "got unexpected token"
+            else:
+                (target, skipped) = other
+                msg = "got unexpected end of input"
+            if skipped is not None and pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if target is not None:
+                pc = target
+                continue
+        elif op == _DISPATCH_TYPE:
+            (table, other) = arg
+            if pos < n:
+                try:
+                    (target, skipped) = table.get(tokens[pos].type, other)
+                except (AttributeError, TypeError):
+                    continue
+                msg = "got unexpected token"
+            else:
+                (target, skipped) = other
+                msg = "got unexpected end of input"
+            if skipped is not None and pos == max_pos:
+                expected = skipped
+                expected_at = pos
+            if target is not None:
+                pc = target
+                continue
+        elif op == _COMMIT:
+            frames.pop()
+            pc = arg
+            continue
+        elif op == _SHIFT:
+            values[-1] = arg(values[-1])
+            continue
+        elif op == _MANY:
+            frames.pop()
+            v = values.pop()
+            values[-1].append(v)
+            pc = arg
+            continue
+        elif op == _MATCH_MANY:
+            # Scan the tokens matched by the opcode of many(p) in one go, without a
+            # choice frame per token
+            (match_op, match_arg) = arg
+            start = pos
+            if match_op == _MATCH_TYPE:
+                (p, type, as_value, _) = match_arg
+                while pos < n and tokens[pos].type == type:
+                    pos += 1
+            elif match_op == _MATCH_EQ:
+                (p, value, as_value, _) = match_arg
+                while pos < n and tokens[pos] == value:
+                    pos += 1
+            elif match_op == _MATCH_TOKEN:
+                (p, type, value, token, as_value, _) = match_arg
+                while pos < n:
+                    t = tokens[pos]
+                    if not (
+                        t.type == type and t.value == value
+                        if t.__class__ is Token
+                        else t == token
+                    ):
+                        break
+                    pos += 1
+            else:
+                (p, pred, _) = match_arg
+                as_value = False
+                while pos < n and pred(tokens[pos]):
+                    pos += 1
+            if pos > start:
+                matched = tokens[start:pos]
+                values[-1].extend([t.value for t in matched] if as_value else matched)
+                if pos > max_pos:
+                    max_pos = pos
+            if pos == max_pos:
+                expected = p
+                expected_at = pos
+            continue
+        elif op == _PUSH_LIST:
+            values.append([])
+            continue
+        elif op == _APPEND:
+            v = values.pop()
+            values[-1].append(v)
+            continue
+        elif op == _IGNORE:
+            v = values[-1]
+            if not isinstance(v, _Ignored):
+                values[-1] = _Ignored(v)
+            continue
+        elif op == _PURE:
+            values.append(arg)
+            continue
+        elif op == _FINISHED:
+            if pos >= n:
+                values.append(None)
+                continue
+            msg = "got unexpected token"
+            if pos == max_pos:
+                expected = arg
+                expected_at = pos
+        elif op == _CALL:
+            try:
+                (v, s2) = arg.run(tokens, State(pos, max_pos, expected))
+            except NoParseError as e:
+                msg = e.msg
+                max_pos = e.state.max
+                if e.state.parser is not expected:
+                    expected = e.state.parser
+                    expected_at = max_pos
+            else:
+                values.append(v)
+                pos = s2.pos
+                max_pos = s2.max
+                if s2.parser is not expected:
+                    expected = s2.parser
+                    expected_at = max_pos
+                continue
+        elif op == _CALL_MEMO:
+            (rule, address) = arg
+            entry = memo[pos].get(rule)
+            if entry is None:
+                if len(frames) >= max_depth:
+                    raise RecursionError("maximum recursion depth exceeded in a rule")
+                caller = (rule, pc, max_pos, expected, expected_at)
+                frames.append((None, pos, len(values), caller))
+                max_pos = pos
+                expected = None
+                expected_at = -1
+                pc = address
+                continue
+            (ok, v, end, rule_max, rule_expected, rule_expected_at) = entry
+            if rule_expected_at >= max_pos:
+                expected = rule_expected
+                expected_at = rule_expected_at
+            if rule_max > max_pos:
+                max_pos = rule_max
+            if ok:
+                values.append(v)
+                pos = end
+                continue
+            msg = v
+        elif op == _CALL_SECTION:
+            if len(frames) >= max_depth:
+                raise RecursionError("maximum recursion depth exceeded in a rule")
+            frames.append((None, pos, 0, pc))
+            pc = arg
+            continue
+        elif op == _RETURN_SECTION:
+            pc = frames.pop()[3]
+            continue
+        elif op == _RETURN:
+            (_, start, _, (rule, pc, caller_max, caller_expected, caller_at)) = (
+                frames.pop()
+            )
+            memo[start][rule] = (True, values[-1], pos, max_pos, expected, expected_at)
+            if expected_at < caller_max:
+                expected = caller_expected
+                expected_at = caller_at
+            if caller_max > max_pos:
+                max_pos = caller_max
+            continue
+        else:
+            return values.pop(), State(pos, max_pos, expected)
+
+        # The opcode failed: backtrack to the innermost alternative left to try. The
+        # frames of the choices given up on name the parser to expect instead.
+        while frames:
+            (target, start, depth, failed) = frames.pop()
+            if target is not None:
+                if failed is not None and start == max_pos:
+                    expected = failed
+                    expected_at = start
+                pos = start
+                del values[depth:]
+                pc = target
+                break
+            elif failed.__class__ is int:
+                # Leave the section called from there
+                continue
+            elif failed.__class__ is tuple:
+                # The rule failed, return its failure to the caller
+                (rule, _, caller_max, caller_expected, caller_at) = failed
+                memo[start][rule] = (False, msg, None, max_pos, expected, expected_at)
+                if expected_at < caller_max:
+                    expected = caller_expected
+                    expected_at = caller_at
+                if caller_max > max_pos:
+                    max_pos = caller_max
+            elif start == max_pos:
+                expected = failed
+                expected_at = start
+        else:
+            raise NoParseError(msg, State(pos, max_pos, expected))
 
 
-finished.name = "end of input"
+finished = _FinishedParser()
 
 
 def many(p):
@@ -547,25 +1889,7 @@ def many(p):
 
     ```
     """
-
-    @Parser
-    def _many(tokens, s):
-        res = []
-        try:
-            while True:
-                (v, s) = p.run(tokens, s)
-                res.append(v)
-        except NoParseError as e:
-            s2 = State(s.pos, e.state.max, e.state.parser)
-            if debug:
-                log.debug(
-                    "*matched* %d instances of %s, new state = %s"
-                    % (len(res), _many.name, s2)
-                )
-            return res, s2
-
-    _many.name = "{ %s }" % p.name
-    return _many
+    return _ManyNode(p)
 
 
 def some(pred):
@@ -595,30 +1919,7 @@ def some(pred):
         and maybe its value, use `tok(type[, value])` instead. You should use
         `make_tokenizer()` from `funcparserlib.lexer` to tokenize your text first.
     """
-
-    @Parser
-    def _some(tokens, s):
-        if s.pos >= len(tokens):
-            s2 = State(s.pos, s.max, _some if s.pos == s.max else s.parser)
-            raise NoParseError("got unexpected end of input", s2)
-        else:
-            t = tokens[s.pos]
-            if pred(t):
-                pos = s.pos + 1
-                s2 = State(pos, max(pos, s.max), s.parser)
-                if debug:
-                    log.debug("*matched* %r, new state = %s" % (t, s2))
-                return t, s2
-            else:
-                s2 = State(s.pos, s.max, _some if s.pos == s.max else s.parser)
-                if debug:
-                    log.debug(
-                        "failed %r, state = %s, expected = %s" % (t, s2, s2.parser.name)
-                    )
-                raise NoParseError("got unexpected token", s2)
-
-    _some.name = "some(...)"
-    return _some
+    return _SomeParser(pred)
 
 
 def a(value):
@@ -652,7 +1953,9 @@ def a(value):
         lexical and syntactic levels of the grammar.
     """
     name = getattr(value, "name", value)
-    return some(lambda t: t == value).named(repr(name))
+    if value.__class__ is Token:
+        return _TokExactParser(value).named(repr(name))
+    return _EqParser(value).named(repr(name))
 
 
 def tok(type, value=None):
@@ -700,8 +2003,8 @@ def tok(type, value=None):
     if value is not None:
         p = a(Token(type, value))
     else:
-        p = some(lambda t: t.type == type).named(type)
-    return (p >> (lambda t: t.value)).named(p.name)
+        p = _TokTypeParser(type)
+    return _TokParser(p)
 
 
 def pure(x):
@@ -714,13 +2017,7 @@ def pure(x):
 
     Also known as `return` in Haskell.
     """
-
-    @Parser
-    def _pure(_, s):
-        return x, s
-
-    _pure.name = "(pure %r)" % (x,)
-    return _pure
+    return _PureParser(x)
 
 
 def maybe(p):
@@ -737,7 +2034,7 @@ def maybe(p):
 
     ```
     """
-    return (p | pure(None)).named("[ %s ]" % (p.name,))
+    return _MaybeNode(p)
 
 
 def skip(p):
@@ -749,29 +2046,27 @@ def skip(p):
 
 
 class _IgnoredParser(Parser):
+    _kind = _K_IGNORE
+
     def __init__(self, p):
-        super(_IgnoredParser, self).__init__(p)
-        run = self._run if debug else self.run
+        self.p = p
+        self.name = p.name
 
-        def ignored(tokens, s):
-            v, s2 = run(tokens, s)
-            return v if isinstance(v, _Ignored) else _Ignored(v), s2
+    def run(self, tokens, s):
+        v, s2 = self.p.run(tokens, s)
+        return v if isinstance(v, _Ignored) else _Ignored(v), s2
 
-        self.define(ignored)
-        self.name = getattr(p, "name", p.__doc__)
+    def _try_run(self, tokens, s):
+        v, s2 = self.p._try_run(tokens, s)
+        if v is _FAILED or isinstance(v, _Ignored):
+            return v, s2
+        return _Ignored(v), s2
 
     def __add__(self, other):
-        def ignored_left(tokens, s):
-            _, s2 = self.run(tokens, s)
-            v, s3 = other.run(tokens, s2)
-            return v, s3
-
         if isinstance(other, _IgnoredParser):
-            return _IgnoredParser(ignored_left).named(
-                "(%s, %s)" % (self.name, other.name)
-            )
+            return _IgnoredParser(_SeqNode(self, other))
         else:
-            return Parser(ignored_left).named("(%s, %s)" % (self.name, other.name))
+            return _SeqNode(self, other)
 
 
 def oneplus(p):
@@ -795,15 +2090,7 @@ def oneplus(p):
 
     ```
     """
-
-    @Parser
-    def _oneplus(tokens, s):
-        (v1, s2) = p.run(tokens, s)
-        (v2, s3) = many(p).run(tokens, s2)
-        return [v1] + v2, s3
-
-    _oneplus.name = "(%s, { %s })" % (p.name, p.name)
-    return _oneplus
+    return _OnePlusNode(p)
 
 
 def with_forward_decls(suspension):
@@ -866,6 +2153,71 @@ def forward_decl():
     return f
 
 
+def _logged(run):
+    """Return the method `run` logging the parser it runs first."""
+
+    def logged_run(self, tokens, s):
+        log.debug("trying %s" % self.name)
+        return run(self, tokens, s)
+
+    return logged_run
+
+
+# The methods the parsers run, and the ones logging their runs, which replace them
+# while `debug` is set
+_runs = [
+    (Parser, "run", Parser.run, _logged(Parser.run)),
+    (_SeqNode, "_parts", _SeqNode._parts, _SeqNode._logged_parts),
+    (_AltNode, "run", _AltNode.run, _logged(_AltNode.run)),
+    (_AltNode, "_try_run", _AltNode._try_run, _logged(_AltNode._try_run)),
+    (_ShiftNode, "run", _ShiftNode.run, _logged(_ShiftNode.run)),
+    (_ShiftNode, "_try_run", _ShiftNode._try_run, _logged(_ShiftNode._try_run)),
+    (_ManyNode, "run", _ManyNode.run, _ManyNode._logged_run),
+    (_ManyNode, "_try_run", _ManyNode.run, _ManyNode._logged_run),
+    (_OnePlusNode, "run", _OnePlusNode.run, _logged(_OnePlusNode.run)),
+    (_OnePlusNode, "_try_run", _OnePlusNode._try_run, _logged(_OnePlusNode._try_run)),
+    (_MaybeNode, "run", _MaybeNode.run, _logged(_MaybeNode.run)),
+    (_MaybeNode, "_try_run", _MaybeNode.run, _logged(_MaybeNode.run)),
+    (_SomeParser, "run", _SomeParser.run, _SomeParser._logged_run),
+    (_SomeParser, "_try_run", _SomeParser._try_run, Parser._try_run),
+    (_TokParser, "run", _TokParser.run, _logged(_TokParser.run)),
+    (_TokParser, "_try_run", _TokParser._try_run, _logged(_TokParser._try_run)),
+    (_PureParser, "run", _PureParser.run, _logged(_PureParser.run)),
+    (_FinishedParser, "run", _FinishedParser.run, _logged(_FinishedParser.run)),
+    (_IgnoredParser, "run", _IgnoredParser.run, _logged(_IgnoredParser.run)),
+    (
+        _IgnoredParser,
+        "_try_run",
+        _IgnoredParser._try_run,
+        _logged(_IgnoredParser._try_run),
+    ),
+]
+
+
+def _log_runs(on):
+    """Make the parsers run the methods logging their runs if `on`, or the ones that
+    don't otherwise, rather than checking `debug` on every run."""
+    global _logging
+    _logging = bool(on)
+    for cls, name, run, logged_run in _runs:
+        setattr(cls, name, logged_run if _logging else run)
+    for p in list(_defined):
+        p._bind()
+
+
+# The C version of _vm_run(), see _vm.pyx. It imports this module by its package
+# name, so register it under that name when it's loaded under another one (e.g. as
+# `__main__` or by `python -m doctest`) for it to raise the same NoParseError
+_name = "lint_lib._vendor.funcparserlib.parser"
+if __name__ != _name:
+    sys.modules.setdefault(_name, sys.modules[__name__])
+del _name
+try:
+    from lint_lib._vendor.funcparserlib._vm import vm_run as _fast_vm_run
+except ImportError:
+    _fast_vm_run = _vm_run
+
+
 if __name__ == "__main__":
     import doctest
 
@@ -38,6 +38,8 @@ class Parser(Generic[_A, _B]):
     def define(self, p: Union[Parser[_A, _B], _ParserCallable]) -> None: ...
     def run(self, tokens: Sequence[_A], s: State) -> Tuple[_B, State]: ...
     def parse(self, tokens: Sequence[_A]) -> _B: ...
+    def parse_packrat(self, tokens: Sequence[_A]) -> _B: ...
+    def parse_fast(self, tokens: Sequence[_A]) -> _B: ...
     @overload
     def __add__(  # type: ignore[misc]
         self, other: _IgnoredParser[_A]
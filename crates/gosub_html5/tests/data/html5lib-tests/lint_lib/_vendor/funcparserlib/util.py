@@ -53,20 +53,24 @@ def pretty_tree(x, kids, show):
     """
     (MID, END, CONT, LAST, ROOT) = ("|-- ", "`-- ", "|   ", "    ", "")
 
-    def rec(obj, indent, sym):
-        line = indent + sym + show(obj)
+    # The objects are visited depth-first with an explicit stack of the ones left to
+    # show, so deep trees don't hit the recursion limit
+    lines = []
+    stack = [(x, "", ROOT)]
+    while stack:
+        (obj, indent, sym) = stack.pop()
+        lines.append(indent + sym + show(obj))
         obj_kids = kids(obj)
         if len(obj_kids) == 0:
-            return line
+            continue
+        if sym == MID:
+            next_indent = indent + CONT
+        elif sym == ROOT:
+            next_indent = indent + ROOT
         else:
-            if sym == MID:
-                next_indent = indent + CONT
-            elif sym == ROOT:
-                next_indent = indent + ROOT
-            else:
-                next_indent = indent + LAST
-            chars = [MID] * (len(obj_kids) - 1) + [END]
-            lines = [rec(kid, next_indent, sym) for kid, sym in zip(obj_kids, chars)]
-            return "\n".join([line] + lines)
-
-    return rec(x, "", ROOT)
+            next_indent = indent + LAST
+        last = len(obj_kids) - 1
+        stack.append((obj_kids[last], next_indent, END))
+        for i in range(last - 1, -1, -1):
+            stack.append((obj_kids[i], next_indent, MID))
+    return "\n".join(lines)
@@ -1,13 +1,23 @@
 import codecs
-import contextlib
-import io
 import json
 import os
 import re
 import sys
-from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache, partial
 from os.path import dirname, join, pardir, relpath
-from typing import Any, Dict, List, Optional, Set, TypeVar
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 from . import parser
 from ._vendor.funcparserlib.parser import NoParseError
@@ -20,30 +30,96 @@ StringLike = TypeVar("StringLike", str, bytes)
 base = join(dirname(__file__), pardir)
 
 _surrogateRe = re.compile(r"\\u([0-9A-Fa-f]{4})(?:\\u([0-9A-Fa-f]{4}))?")
+_escapesRe = re.compile(r"(?:\\u[0-9A-Fa-f]{4})+")
+
+_tokenizer_all_keys = frozenset(
+    {
+        "description",
+        "input",
+        "output",
+        "initialStates",
+        "lastStartTag",
+        "ignoreErrorOrder",
+        "doubleEscaped",
+        "errors",
+    }
+)
+_tokenizer_required_keys = frozenset({"input", "output"})
+
+
+@lru_cache(maxsize=4096)
+def _clean_dir(path: str, start: str) -> str:
+    return relpath(path, start)
 
 
 def clean_path(path: str) -> str:
-    return relpath(path, base)
+    # Files share their directories, so only resolve each directory once.
+    head, tail = os.path.split(path)
+    head = _clean_dir(head, base)
+    return tail if head == os.curdir else join(head, tail)
+
+
+def _iter_files(root: str, suffix: str) -> Iterator[str]:
+    """Yields the files under root whose name ends with suffix
+
+    The files are yielded in no particular order. This relies on the
+    d_type information cached on each DirEntry rather than stat()ing
+    every entry like os.walk does.
+    """
+    stack = [root]
+    while stack:
+        top = stack.pop()
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(suffix) and entry.is_file():
+                        yield entry.path
+        except OSError:
+            continue
+
+
+def _lint_file(lint: Callable[[str, List[str]], None], path: str) -> List[str]:
+    msgs: List[str] = []
+    lint(path, msgs)
+    return msgs
 
 
-def is_subsequence(l1: List[StringLike], l2: List[StringLike]) -> bool:
-    """checks if l1 is a subsequence of l2"""
-    i = 0
-    for x in l2:
-        if l1[i] == x:
-            i += 1
-            if i == len(l1):
-                return True
-    return False
+def _lint_files(
+    lint: Callable[[str, List[str]], None],
+    paths: List[str],
+    msgs: List[str],
+    executor: Optional[Executor],
+) -> None:
+    """Runs lint on each of paths, in parallel if given an executor
+
+    The files are independent of each other, and the diagnostics are
+    collected in the order of paths whichever worker finishes first.
+    """
+    if executor is None:
+        for path in paths:
+            lint(path, msgs)
+    else:
+        for file_msgs in executor.map(partial(_lint_file, lint), paths, chunksize=16):
+            msgs.extend(file_msgs)
 
 
 def unescape_json(obj: Any) -> Any:
+    """Decode \\uXXXX escapes in all the strings of obj
+
+    Dicts and lists are updated in place, walking them with an explicit
+    stack rather than by recursion.
+    """
+
     def decode_str(inp):
         """Decode \\uXXXX escapes
 
         This decodes \\uXXXX escapes, possibly into non-BMP characters when
         two surrogate character escapes are adjacent to each other.
         """
+        if "\\u" not in inp:
+            return inp
 
         # This cannot be implemented using the unicode_escape codec
         # because that requires its input be ISO-8859-1, and we need
@@ -64,39 +140,80 @@ def unescape_json(obj: Any) -> Any:
             else:
                 return chr(int(m.group(1), 16))
 
-        return _surrogateRe.sub(repl, inp)
+        # Each run of adjacent escapes is decoded as UTF-16 code units by
+        # the codec, in one go.
+        def repl_run(m):
+            run = m.group()
+            decoded = bytes.fromhex(run.replace("\\u", "")).decode(
+                "utf-16-be", "surrogatepass"
+            )
+            if len(decoded) * 6 == len(run):
+                return decoded
+            # The codec decoded a surrogate pair, which _surrogateRe might
+            # not pair up the same way since it pairs escapes from the start
+            # of the run.
+            return _surrogateRe.sub(repl, run)
+
+        return _escapesRe.sub(repl_run, inp)
 
-    if isinstance(obj, dict):
-        return {decode_str(k): unescape_json(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [unescape_json(x) for x in obj]
-    elif isinstance(obj, text_type):
+    if isinstance(obj, text_type):
         return decode_str(obj)
-    else:
-        return obj
+
+    stack = [obj]
+    while stack:
+        container = stack.pop()
+        slots: Iterable[Tuple[Any, Any]]
+        if isinstance(container, dict):
+            if any("\\u" in k for k in container):
+                items = list(container.items())
+                container.clear()
+                for k, v in items:
+                    container[decode_str(k)] = v
+            slots = container.items()
+        elif isinstance(container, list):
+            slots = enumerate(container)
+        else:
+            continue
+        for k, v in slots:
+            if isinstance(v, text_type):
+                container[k] = decode_str(v)
+            elif isinstance(v, (dict, list)):
+                stack.append(v)
+    return obj
 
 
 def lint_dat_format(
     path: str,
     encoding: Optional[str],
     first_header: StringLike,
+    msgs: List[str],
     expected_headers: Optional[List[StringLike]] = None,
     input_headers: Optional[Set[StringLike]] = None,
 ) -> List[Dict[StringLike, StringLike]]:
-    if expected_headers is not None and first_header not in expected_headers:
+    if expected_headers is not None:
+        expected_set = set(expected_headers)
+        # Position of each header, for checking the order of an item's headers.
+        expected_index = {header: i for i, header in enumerate(expected_headers)}
+    else:
+        expected_set = None
+        expected_index = None
+
+    if expected_set is not None and first_header not in expected_set:
         raise ValueError("First header must be an expected header. (lint config error)")
 
     if (
         input_headers is not None
-        and expected_headers is not None
-        and not (set(input_headers) < set(expected_headers))
+        and expected_set is not None
+        and not (set(input_headers) < expected_set)
     ):
         raise ValueError(
             "Input header must be a subset of expected headers. (lint config error)"
         )
 
-    if expected_headers is not None and len(set(expected_headers)) < len(
-        expected_headers
+    if (
+        expected_headers is not None
+        and expected_set is not None
+        and len(expected_set) < len(expected_headers)
     ):
         raise ValueError(
             "Can't expect a single header multiple times. (lint config error)"
@@ -105,6 +222,9 @@ def lint_dat_format(
     if input_headers is None:
         input_headers = set(expected_headers)
 
+    # Items are keyed by the values of their input headers, in a fixed order.
+    input_keys = tuple(sorted(input_headers))
+
     try:
         if encoding is not None:
             with codecs.open(path, "r", encoding=encoding) as fp:
@@ -115,56 +235,53 @@ def lint_dat_format(
                 dat = fp.read()
                 parsed = parser.parse(dat, first_header)
     except NoParseError as e:
-        print("Parse error in {}, {}".format(path, e))
+        msgs.append("Parse error in {}, {}".format(path, e))
         return
 
     seen_items = {}
 
     for item in parsed:
         # Check we don't have duplicate headers within one item.
-        headers = Counter(x[0] for x in item.data)
-        headers.subtract(set(headers.elements()))  # remove one instance of each
-        for header in set(headers.elements()):
-            c = headers[header]
-            print(
-                f"Duplicate header {header!r} occurs {c+1} times in one item in {path} at line {item.lineno}"
-            )
+        counts: Dict[StringLike, int] = {}
+        for header, _ in item.data:
+            counts[header] = counts.get(header, 0) + 1
+        for header, c in counts.items():
+            if c > 1:
+                msgs.append(
+                    f"Duplicate header {header!r} occurs {c} times in one item in {path} at line {item.lineno}"
+                )
 
         item_dict = dict(item.data)
 
-        # Check we only have expected headers.
-        if expected_headers is not None:
-            if not is_subsequence(
-                list(item_dict.keys()),
-                expected_headers,
-            ):
-                unexpected = item_dict.keys()
-                print(
-                    f"Unexpected item headings in {list(unexpected)!r} in {path} at line {item.lineno}"
-                )
+        # Check we only have expected headers, in the expected order.
+        if expected_index is not None:
+            prev = -1
+            for header in item_dict:
+                i = expected_index.get(header)
+                if i is None or i <= prev:
+                    msgs.append(
+                        f"Unexpected item headings in {list(item_dict)!r} in {path} at line {item.lineno}"
+                    )
+                    break
+                prev = i
 
         # Check for duplicated items.
-        if input_headers is not None:
-            found_input = set()
-            for input_header in input_headers:
-                found_input.add((input_header, item_dict.get(input_header)))
-        else:
-            found_input = set(item_dict.items())
-
-        first_line = seen_items.setdefault(frozenset(found_input), item.lineno)
+        key = tuple(map(item_dict.get, input_keys))
+        first_line = seen_items.setdefault(key, item.lineno)
         if first_line is not None and first_line != item.lineno:
-            print(
+            msgs.append(
                 f"Duplicate item in {path} at line {item.lineno} previously seen on line {first_line}"
             )
 
     return [dict(x.data) for x in parsed]
 
 
-def lint_encoding_test(path: str) -> None:
+def lint_encoding_test(path: str, msgs: List[str]) -> None:
     parsed = lint_dat_format(
         path,
         None,
         b"data",
+        msgs,
         expected_headers=[b"data", b"encoding"],
         input_headers={b"data"},
     )
@@ -176,64 +293,57 @@ def lint_encoding_test(path: str) -> None:
     # encoding tests here.
 
 
-def lint_encoding_tests(path: str) -> None:
-    for root, dirs, files in os.walk(path):
-        for file in sorted(files):
-            if not file.endswith(".dat"):
-                continue
-            lint_encoding_test(clean_path(join(root, file)))
+def lint_encoding_tests(
+    path: str, msgs: List[str], executor: Optional[Executor] = None
+) -> None:
+    paths = sorted(clean_path(file) for file in _iter_files(path, ".dat"))
+    _lint_files(lint_encoding_test, paths, msgs, executor)
 
 
-def lint_tokenizer_test(path: str) -> None:
-    all_keys = {
-        "description",
-        "input",
-        "output",
-        "initialStates",
-        "lastStartTag",
-        "ignoreErrorOrder",
-        "doubleEscaped",
-        "errors",
-    }
-    required = {"input", "output"}
-    with codecs.open(path, "r", "utf-8") as fp:
-        parsed = json.load(fp)
+def lint_tokenizer_test(path: str, msgs: List[str]) -> None:
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if not data:
+        return
+    parsed = json.loads(data)
     if not parsed:
         return
     if not isinstance(parsed, dict):
-        print("Top-level must be an object in %s" % path)
+        msgs.append("Top-level must be an object in %s" % path)
         return
     for test_group in parsed.values():
         if not isinstance(test_group, list):
-            print("Test groups must be a lists in %s" % path)
+            msgs.append("Test groups must be a lists in %s" % path)
             continue
         for test in test_group:
             if "doubleEscaped" in test and test["doubleEscaped"] is True:
                 test = unescape_json(test)
             keys = set(test.keys())
-            if not (required <= keys):
-                print(
-                    "missing test properties {!r} in {}".format(required - keys, path)
+            if not (_tokenizer_required_keys <= keys):
+                missing = set(_tokenizer_required_keys) - keys
+                msgs.append(
+                    "missing test properties {!r} in {}".format(missing, path)
                 )
-            if not (keys <= all_keys):
-                print(
-                    "unknown test properties {!r} in {}".format(keys - all_keys, path)
+            if not (keys <= _tokenizer_all_keys):
+                unknown = keys - _tokenizer_all_keys
+                msgs.append(
+                    "unknown test properties {!r} in {}".format(unknown, path)
                 )
 
 
-def lint_tokenizer_tests(path: str) -> None:
-    for root, dirs, files in os.walk(path):
-        for file in sorted(files):
-            if not file.endswith(".test"):
-                continue
-            lint_tokenizer_test(clean_path(join(root, file)))
+def lint_tokenizer_tests(
+    path: str, msgs: List[str], executor: Optional[Executor] = None
+) -> None:
+    paths = sorted(clean_path(file) for file in _iter_files(path, ".test"))
+    _lint_files(lint_tokenizer_test, paths, msgs, executor)
 
 
-def lint_tree_construction_test(path: str) -> None:
+def lint_tree_construction_test(path: str, msgs: List[str]) -> None:
     parsed = lint_dat_format(
         path,
         "utf-8",
         "data",
+        msgs,
         expected_headers=[
             "data",
             "errors",
@@ -258,22 +368,23 @@ def lint_tree_construction_test(path: str) -> None:
     # tree construction tests here.
 
 
-def lint_tree_construction_tests(path: str) -> None:
-    for root, dirs, files in os.walk(path):
-        for file in sorted(files):
-            if not file.endswith(".dat"):
-                continue
-            lint_tree_construction_test(clean_path(join(root, file)))
+def lint_tree_construction_tests(
+    path: str, msgs: List[str], executor: Optional[Executor] = None
+) -> None:
+    paths = sorted(clean_path(file) for file in _iter_files(path, ".dat"))
+    _lint_files(lint_tree_construction_test, paths, msgs, executor)
 
 
 def main() -> int:
-    with contextlib.redirect_stdout(io.StringIO()) as f:
-        lint_encoding_tests(join(base, "encoding"))
-        lint_tokenizer_tests(join(base, "tokenizer"))
-        lint_tree_construction_tests(join(base, "tree-construction"))
-
-    print(f.getvalue(), end="")
-    return 0 if f.getvalue() == "" else 1
+    msgs: List[str] = []
+    with ProcessPoolExecutor() as executor:
+        lint_encoding_tests(join(base, "encoding"), msgs, executor)
+        lint_tokenizer_tests(join(base, "tokenizer"), msgs, executor)
+        lint_tree_construction_tests(join(base, "tree-construction"), msgs, executor)
+
+    if msgs:
+        sys.stdout.write("\n".join(msgs) + "\n")
+    return 0 if not msgs else 1
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 from typing import Callable, List, Optional, Tuple, Type, TypeVar, Union
 
 from ._vendor.funcparserlib.lexer import LexerError, Token
@@ -25,56 +26,64 @@ class Test:
         self.lineno = lineno
 
 
-def _make_tokenizer(specs: List[Tuple[str, Tuple[StringLike]]]) -> Callable:
+def _make_tokenizer(specs: List[Tuple[str, Tuple[StringLike], bool]]) -> Callable:
     # Forked from upstream funcparserlib.lexer to fix #46
-    def compile_spec(spec):
-        name, args = spec
-        return name, re.compile(*args)
+    #
+    # All the specs are joined into a single alternation so each token is
+    # matched in one pass of the regexp engine, the name of the matching
+    # group being the type of the token. As with the upstream lexer, the
+    # specs are tried in order. Each spec says whether its tokens may
+    # contain newlines; only those tokens are searched for them.
+    def group(spec):
+        name, (pattern,), _ = spec
+        if isinstance(pattern, str):
+            return "(?P<%s>%s)" % (name, pattern)
+        else:
+            return b"(?P<%s>%s)" % (name.encode("ascii"), pattern)
 
-    compiled = [compile_spec(s) for s in specs]
+    groups = [group(s) for s in specs]
+    sep = "|" if isinstance(groups[0], str) else b"|"
+    regexp = re.compile(sep.join(groups))
+    multiline = {name for name, _, has_nl in specs if has_nl}
 
-    def match_specs(specs, s, i, position):
-        if isinstance(s, str):
-            lf = "\n"
-        else:
-            lf = b"\n"
-        line, pos = position
-        for type, regexp in specs:
+    def f(s):
+        lf = "\n" if isinstance(s, str) else b"\n"
+        length = len(s)
+        line, pos = 1, 0
+        i = 0
+        while i < length:
             m = regexp.match(s, i)
-            if m is not None:
-                value = m.group()
+            if m is None:
+                errline = s.splitlines()[line - 1]
+                raise LexerError((line, pos + 1), errline)
+            type = m.lastgroup
+            value = m.group()
+            end = m.end()
+            if type not in multiline:
+                n_line, n_pos = line, pos + end - i
+            else:
                 nls = value.count(lf)
                 n_line = line + nls
                 if nls == 0:
-                    n_pos = pos + len(value)
+                    n_pos = pos + end - i
                 else:
                     n_pos = len(value) - value.rfind(lf) - 1
-                return Token(type, value, (line, pos + 1), (n_line, n_pos))
-        else:
-            errline = s.splitlines()[line - 1]
-            raise LexerError((line, pos + 1), errline)
-
-    def f(s):
-        length = len(s)
-        line, pos = 1, 0
-        i = 0
-        while i < length:
-            t = match_specs(compiled, s, i, (line, pos))
-            yield t
-            line, pos = t.end
-            i += len(t.value)
+            yield Token(type, value, (line, pos + 1), (n_line, n_pos))
+            line, pos = n_line, n_pos
+            i = end
 
     return f
 
 
 _token_specs_u = [
-    ("HEADER", (r"[ \t]*#[^\n]*",)),
-    ("BODY", (r"[^#\n][^\n]*",)),
-    ("EOL", (r"\n",)),
+    ("HEADER", (r"[ \t]*#[^\n]*",), False),
+    ("BODY", (r"[^#\n][^\n]*",), False),
+    ("EOL", (r"\n",), True),
 ]
 
 _token_specs_b = [
-    (name, (regexp.encode("ascii"),)) for (name, (regexp,)) in _token_specs_u
+    (name, (regexp.encode("ascii"),), has_nl)
+    for (name, (regexp,), has_nl) in _token_specs_u
 ]
 
 _tokenizer_u = _make_tokenizer(_token_specs_u)
@@ -113,36 +122,33 @@ def _make_test(result: _Tuple) -> Test:
     return Test([(first_header, first_body)] + rest, lineno=first_lineno)
 
 
-def _parser(
-    tokens: List[Token],
+@lru_cache(maxsize=None)
+def _grammar(
     new_test_header: StringLike,
     tok_type: Union[Type[str], Type[bytes]],
-) -> List[Test]:
+) -> Parser:
+    # Built once per header, so that the code funcparserlib compiles for it on
+    # the first parse is reused by the later ones.
     if tok_type is str:
         header_prefix = "#"
     elif tok_type is bytes:
         header_prefix = b"#"
     else:
         assert False, "unreachable"
+    full_header = header_prefix + new_test_header
 
     first_header = (
-        some(
-            lambda tok: tok.type == "HEADER"
-            and tok.value == header_prefix + new_test_header
-        )
+        some(lambda tok: tok.type == "HEADER" and tok.value == full_header)
         >> (
             lambda x: (
-                _trim_prefix(x.value, header_prefix),
+                new_test_header,
                 x.start[0] if x.start is not None else None,
             )
         )
     ) + skip(tok("EOL"))
 
     header = (
-        some(
-            lambda tok: tok.type == "HEADER"
-            and tok.value != header_prefix + new_test_header
-        )
+        some(lambda tok: tok.type == "HEADER" and tok.value != full_header)
         >> (lambda x: _trim_prefix(x.value, header_prefix))
     ) + skip(tok("EOL"))
 
@@ -160,9 +166,79 @@ def _parser(
 
     tests = (test + many(skip(empty) + test)) >> _many_merge
 
-    toplevel = tests + skip(finished)
+    return tests + skip(finished)
+
+
+def _parser(
+    tokens: List[Token],
+    new_test_header: StringLike,
+    tok_type: Union[Type[str], Type[bytes]],
+) -> List[Test]:
+    return _grammar(new_test_header, tok_type).parse_fast(tokens)
+
+
+def _parse_lines(s: StringLike, new_test_header: StringLike) -> Optional[List[Test]]:
+    """Parses s line by line, returning None if it is malformed
 
-    return toplevel.parse(tokens)
+    This accepts the same inputs as _parser and gives the same results,
+    without tokenizing s or running the parsing combinators. Malformed
+    inputs are left for _parser to report the error.
+
+    Only header lines are copied out of s; each body is a single slice
+    of s, so no per-line strings or tokens are allocated for it.
+    """
+    if isinstance(s, str):
+        nl, prefix, blanks, indents = "\n", "#", " \t", (" ", "\t")
+    else:
+        nl, prefix, blanks, indents = b"\n", b"#", b" \t", (b" ", b"\t")
+    full_header = prefix + new_test_header
+
+    # Every line, including the last one, must end with a newline, and the
+    # first one must start a test.
+    if not s.startswith(full_header + nl) or not s.endswith(nl):
+        return None
+
+    tests = []
+    data: List[Tuple[StringLike, StringLike]] = []
+    header: Optional[StringLike] = None
+    body_start = 0
+    lineno = 0
+    i = 0
+    length = len(s)
+    while i < length:
+        j = s.index(nl, i)
+        lineno += 1
+        # Header lines are told apart with startswith() rather than the
+        # HEADER regexp, and only indented lines need stripping.
+        if s.startswith(prefix, i) or (
+            s.startswith(indents, i) and s[i:j].lstrip(blanks).startswith(prefix)
+        ):
+            line = s[i:j]
+            new_test = line == full_header
+            if header is not None:
+                # The body ends with the newline of the previous line.
+                body_end = i - 1
+                if new_test:
+                    # Tests are separated by an empty line, which isn't part
+                    # of the body of the last header.
+                    if i == body_start or not s.startswith(nl, i - 2):
+                        return None
+                    body_end = i - 2
+                data.append((header, s[body_start:body_end]))
+
+            if new_test:
+                data = []
+                tests.append(Test(data, lineno=lineno))
+                header = new_test_header
+            else:
+                header = _trim_prefix(line, prefix)
+            body_start = j + 1
+        i = j + 1
+
+    # The first line starts a test, so there's always a header by now.
+    assert header is not None
+    data.append((header, s[body_start : length - 1]))
+    return tests
 
 
 def parse(s: StringLike, new_test_header: StringLike) -> List[Test]:
@@ -170,8 +246,14 @@ def parse(s: StringLike, new_test_header: StringLike) -> List[Test]:
         raise TypeError("s and new_test_header must have same type")
 
     if isinstance(s, str):
-        return _parser(list(_tokenizer_u(s)), new_test_header, str)
+        tokenizer, tok_type = _tokenizer_u, str
     elif isinstance(s, bytes):
-        return _parser(list(_tokenizer_b(s)), new_test_header, bytes)
+        tokenizer, tok_type = _tokenizer_b, bytes
     else:
         raise TypeError("s must be unicode or bytes object")
+
+    tests = _parse_lines(s, new_test_header)
+    if tests is None:
+        # Go through the parsing combinators to get the error.
+        tests = _parser(list(tokenizer(s)), new_test_header, tok_type)
+    return tests
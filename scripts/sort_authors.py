@@ -1,7 +1,7 @@
 FILE_NAME = 'AUTHORS'
 
 with open(FILE_NAME, 'r') as f:
-    lines = [line.strip() for line in f.readlines()]
+    lines = [line.strip() for line in f.read().splitlines()]
 
 
 header: list[str] = []